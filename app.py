@@ -1,66 +1,52 @@
 import streamlit as st
-import pipeline.data_pull as pull
-import pipeline.data_pull_new as pull_new
-import pipeline.calc_all as calc
-import shutil
-import os
-import merge_tool
-import hubspot_clean as contact_dedup_tool
-import company_metrics as cm
-import dashboard_page as dash 
-import dashboard_page_new as dash_new_v2
-from io import BytesIO
-import pandas as pd
-import pipeline.invoice_data_pull as inv
 import datetime
-from company_metrics import _cli  # or expose a save helper instead
 from io import BytesIO
-from openpyxl.styles import PatternFill
-from openpyxl.utils.dataframe import dataframe_to_rows
-from openpyxl.workbook import Workbook
+import pandas as pd
 
-def excel_with_colours(enriched_df: pd.DataFrame, bench_df: pd.DataFrame) -> BytesIO:
+# Page modules (DB drivers, openpyxl, …) are imported inside the branch /
+# helper that needs them, so each rerun only loads what the chosen page uses.
+
+# Copy-on-Write: pandas 3 always has it; on 2.x opt in, so renames and
+# shallow copies in the page modules (e.g. merge_tool's per-CSV PAN rename)
+# share column data until something is actually written to it.
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def _enrich_cached(file_bytes: bytes, filename: str) -> tuple[pd.DataFrame, pd.DataFrame, bytes]:
     """
-    Return an in-memory XLSX where every '… Deviation %' cell is coloured:
-    ≤20 → green, 20–50 → yellow, >50 → red.
+    Read, enrich and colour an uploaded file once per distinct upload.
+    Streamlit hashes *file_bytes*, so reruns (download clicks, sidebar
+    changes) hit the cache instead of redoing the groupbys and the XLSX.
     """
-    wb = Workbook()
-    wb.remove(wb.active)            # kill default blank sheet
-
-    # Benchmarks sheet
-    ws_bench = wb.create_sheet("Industry Benchmarks")
-    for row in dataframe_to_rows(bench_df, index=False, header=True):
-        ws_bench.append(row)
-
-    # Calculations sheet
-    ws_calc = wb.create_sheet("Calculations")
-    for row in dataframe_to_rows(enriched_df, index=False, header=True):
-        ws_calc.append(row)
-
-    # pastel fills
-    fill_good = PatternFill("solid", fgColor="C6EFCE")   # green
-    fill_avg  = PatternFill("solid", fgColor="FFEB9C")   # yellow
-    fill_bad  = PatternFill("solid", fgColor="F2DCDB")   # red
-
-    # colour every Deviation % column
-    for col_idx, header_cell in enumerate(ws_calc[1], 1):
-        if "Deviation %" in str(header_cell.value):
-            for row_idx in range(2, ws_calc.max_row + 1):
-                cell = ws_calc.cell(row=row_idx, column=col_idx)
-                try:
-                    val = float(cell.value)
-                except (TypeError, ValueError):
-                    continue
-                cell.fill = (
-                    fill_good if val <= 20
-                    else fill_avg if val <= 50
-                    else fill_bad
-                )
+    import company_metrics as cm
 
-    buf = BytesIO()
-    wb.save(buf)
-    buf.seek(0)
-    return buf
+    df = cm.read_table(BytesIO(file_bytes), filename)
+
+    enriched_df, bench_df = cm.enrich_dataframe(df)
+
+    buf = cm.excel_with_colours(enriched_df, bench_df)
+
+    return enriched_df, bench_df, buf.getvalue()
+
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _cached_invoice_pull(from_date, to_date, granularity: str, date_type: str) -> tuple[pd.DataFrame, bytes]:
+    """
+    Run the invoice-level pull once per (dates, granularity, date column)
+    and keep the DataFrame plus its XLSX bytes for an hour.  The workbook
+    is built in memory only; nothing is written to or read from Output/.
+    """
+    import pipeline.invoice_data_pull as inv
+
+    df_inv = inv.run_invoice_pull(
+        from_date   = from_date,
+        to_date     = to_date,
+        granularity = granularity,
+        date_type   = date_type,
+        out_dir     = None,
+    )
+    return df_inv, inv.to_xlsx_bytes(df_inv)
 # import new_logic
 # ─────────────────────────────────────────────
 # 🌟 Page Setup
@@ -78,18 +64,30 @@ nav_choice = st.sidebar.radio("Go to", ["📊 TOFU BOFU Vendor Data + Cat with R
 # 📊 Dashboard Logic
 # ────────────────────────────────────────  ─────
 if nav_choice == "📊 TOFU BOFU Vendor Data + Cat with Revenue":
+    import dashboard_page as dash
+    import pipeline.calc_all as calc
+    import pipeline.data_pull as pull
+
     dash.render(pull_module=pull, calc_module=calc, logo_path="logo.webp")
 elif nav_choice == "📊 Vendor Category and Summary":
+    import dashboard_page_new as dash_new_v2
+    import pipeline.calc_all as calc
+    import pipeline.data_pull_new as pull_new
+
     dash_new_v2.render(pull_module=pull_new, calc_module=calc, logo_path="logo.webp")
 
 # … inside your nav logic:
 elif nav_choice == "🧹 Contact Dedup Tool":
+    import hubspot_clean as contact_dedup_tool
+
     st.title("🧹 Contact Dedup Tool")
     contact_dedup_tool.render_page()
 # ─────────────────────────────────────────────
 # 🧩 Merge Tool Logic
 # ─────────────────────────────────────────────
 elif nav_choice == "🧩 Merge Tool":
+    import merge_tool
+
     st.title("🧩 Excel Merge Tool")
     merge_tool.render_page()
 
@@ -104,26 +102,16 @@ elif nav_choice == "📈 Enrichment Tool":
     if uploaded_file:
         st.success("✅ File uploaded successfully!")
 
-        # Read file
-        df = pd.read_excel(uploaded_file) if uploaded_file.name.endswith("xlsx") else pd.read_csv(uploaded_file)
-
-        # Run enrichment
+        # Read + enrich (cached on the uploaded bytes)
         try:
-            enriched_df, bench_df = cm.enrich_dataframe(df)
+            enriched_df, bench_df, xlsx_bytes = _enrich_cached(
+                uploaded_file.getvalue(), uploaded_file.name
+            )
             st.success("✅ Enrichment completed!")
 
-                # … after enrichment finishes
-            
-            buf = BytesIO()
-            with pd.ExcelWriter(buf, engine="openpyxl") as w:
-                enriched_df.to_excel(w, sheet_name="Enriched Data", index=False)
-                bench_df.to_excel(w, sheet_name="Industry Benchmarks", index=False)
-            buf.seek(0)
-            buf = excel_with_colours(enriched_df, bench_df)
-
             st.download_button(
                 "⬇️ Download Enriched + Benchmark (coloured)",
-                data=buf,
+                data=xlsx_bytes,
                 file_name="enriched_with_benchmarks.xlsx",
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             )
@@ -188,11 +176,8 @@ elif nav_choice == "📁 Invoice Data Pull":
         # --- Button ---
         if st.button("🚀 Run invoice-level pull"):
             with st.spinner("Running query – this may take a minute…"):
-                df_inv = inv.run_invoice_pull(
-                    from_date   = from_date,
-                    to_date     = to_date,
-                    granularity = granularity_sel,
-                    date_type   = date_type_sel
+                df_inv, xlsx_bytes = _cached_invoice_pull(
+                    from_date, to_date, granularity_sel, date_type_sel
                 )
                 # for col in df_inv.select_dtypes(include=["datetimetz"]).columns:
                 #     df_inv[col] = df_inv[col].dt.tz_convert(None)
@@ -202,10 +187,9 @@ elif nav_choice == "📁 Invoice Data Pull":
             
             # --- Download Excel ---
             out_name = f"invoice_metrics_{from_date}_{to_date}_{granularity_sel}.xlsx"
-            with open(f"Output/{out_name}", "rb") as f:
-                st.download_button(
-                    "⬇️ Download Excel",
-                    data=f,
-                    file_name=out_name,
-                    mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-                )
\ No newline at end of file
+            st.download_button(
+                "⬇️ Download Excel",
+                data=xlsx_bytes,
+                file_name=out_name,
+                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+            )
\ No newline at end of file
@@ -15,6 +15,7 @@ Usage in Streamlit
 ------------------
     import company_metrics as cm
     enriched_df, bench_df = cm.enrich_dataframe(df)
+    xlsx_buf = cm.excel_with_colours(enriched_df, bench_df)
 
 CLI
 ---
@@ -25,141 +26,253 @@ from __future__ import annotations
 
 import glob
 import os
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 import argparse
+from io import BytesIO
 import numpy as np
 import pandas as pd
-from openpyxl.styles import PatternFill
-from openpyxl.utils.dataframe import dataframe_to_rows
+
+from pipeline.excel import new_workbook, write_sheet
 
 # ────────────────────────── helpers ──────────────────────────
 def _to_num(s: pd.Series) -> pd.Series:
-    return pd.to_numeric(s, errors="coerce")
+    num = pd.to_numeric(s, errors="coerce")
+    # Arrow / nullable numerics → float64 so NaN comparisons stay False (not NA)
+    if isinstance(num.dtype, pd.api.extensions.ExtensionDtype):
+        num = num.astype("float64")
+    return num
+
 
+def _col_map(df: pd.DataFrame) -> Dict[str, str]:
+    """Lower-cased name → first original column with that name."""
+    cols: Dict[str, str] = {}
+    for c in df.columns:
+        cols.setdefault(str(c).lower(), c)
+    return cols
 
-def _get_col(df: pd.DataFrame, name: str) -> str:
-    mask = df.columns.str.lower() == name.lower()
-    if not mask.any():
+
+def _get_col(df: pd.DataFrame, name: str, cols: Dict[str, str]) -> str:
+    """Actual column for *name* (case-insensitive) via a :func:`_col_map`."""
+    col = cols.get(name.lower())
+    if col is None:
         raise KeyError(f"Column '{name}' not found")
-    return df.columns[mask][0]
+    return col
 
 
 def _safe_series(
-    df: pd.DataFrame, col: str, default=np.nan, numeric: bool = True
+    df: pd.DataFrame,
+    col: str,
+    cols: Dict[str, str],
+    default=np.nan,
+    numeric: bool = True,
 ) -> pd.Series:
     try:
-        s = df[_get_col(df, col)]
+        s = df[_get_col(df, col, cols)]
         return _to_num(s) if numeric else s
     except KeyError:
         return pd.Series(default, index=df.index)
 
 
-def _parse_slab(txt: str | float) -> float:
-    if pd.isna(txt):
-        return np.nan
-    if isinstance(txt, (int, float)):
-        return float(txt)
-
+def read_table(src, filename: str) -> pd.DataFrame:
+    """
+    Load an uploaded / on-disk CSV or Excel file into Arrow-backed columns
+    (strings stay compact Arrow buffers).  Excel goes through the Rust
+    ``calamine`` reader when python-calamine is installed and falls back to
+    pandas' default (openpyxl) otherwise.
+    """
+    if filename.lower().endswith(".csv"):
+        return pd.read_csv(src, dtype_backend="pyarrow")
+    try:
+        return pd.read_excel(src, engine="calamine", dtype_backend="pyarrow")
+    except ImportError:
+        if hasattr(src, "seek"):
+            src.seek(0)
+        return pd.read_excel(src, dtype_backend="pyarrow")
+
+
+def _parse_slab(s: pd.Series) -> pd.Series:
+    """
+    Midpoint of a "Turnover range" column, parsed with vectorised ``.str``
+    ops: "Rs 100 to 500 Cr" → 300, "1,000 Cr and above" → 1000, numeric
+    cells pass through and anything else is NaN.
+    """
+    if pd.api.types.is_numeric_dtype(s):
+        return s.astype(float)
+
+    # .str yields NaN for non-string cells; those keep their numeric value
     txt = (
-        str(txt)
-        .replace("Rs", "")
-        .replace("Cr", "")
-        .replace(",", "")
-        .strip()
-        .lower()
+        s.str.replace(r"Rs|Cr|,", "", regex=True)
+        .str.strip()
+        .str.lower()
+    )
+    numeric = _to_num(s.where(txt.isna()))
+
+    rng = txt.str.extract(r"^(?P<lo>[\d.]+)\s*to\s*(?P<hi>[\d.]+)$")
+    lo = _to_num(rng["lo"])
+    hi = _to_num(rng["hi"])
+    above = _to_num(txt.str.extract(r"^(?P<floor>[\d.]+)\s")["floor"])
+
+    has_to = txt.str.contains("to", regex=False, na=False)
+    has_above = txt.str.contains("and above", regex=False, na=False)
+    out = np.where(
+        has_to, (lo + hi) / 2, np.where(has_above, above, numeric)
+    )
+    return pd.Series(out, index=s.index, dtype=float)
+
+
+def _fy_labels(year: np.ndarray, month: np.ndarray, index: pd.Index) -> pd.Series:
+    """
+    Indian financial-year label per month (April starts the next FY, so
+    Apr-2024 → "FY25").  Year arithmetic runs on NumPy arrays and each
+    distinct FY string is built once; NaT months (NaN year/month) give NaN.
+    """
+    fy_year = np.where(month >= 4, year + 1, year)
+
+    labels = np.full(len(fy_year), np.nan, dtype=object)
+    valid = ~np.isnan(fy_year)
+    if valid.any():
+        lo, hi = int(fy_year[valid].min()), int(fy_year[valid].max())
+        table = np.array([f"FY{str(y)[-2:]}" for y in range(lo, hi + 1)], dtype=object)
+        labels[valid] = table[fy_year[valid].astype(np.int64) - lo]
+    return pd.Series(labels, index=index)
+
+
+def _extrap_fy(
+    supplier: pd.Series, fy: pd.Series, month: np.ndarray, tofu: pd.Series
+) -> pd.DataFrame:
+    """
+    Full-year TOFU extrapolation per (supplier, FY), returned as a
+    supplier × FY frame.  Each group is ``sum + mean * months_rem`` where
+    ``months_rem`` comes from the group's earliest month; groups with no
+    TOFU values are NaN.  Sum / mean / earliest month come from one
+    ``groupby.agg`` over factorized (supplier, FY) codes, so no Python
+    runs per group.
+    """
+    sup_codes, sup_uniques = pd.factorize(supplier, sort=True)
+    fy_codes, fy_uniques = pd.factorize(fy, sort=True)
+    keep = (sup_codes >= 0) & (fy_codes >= 0)  # groupby drops NaN keys
+
+    n_sup, n_fy = len(sup_uniques), len(fy_uniques)
+    parts = pd.DataFrame({
+        "gid": sup_codes[keep] * n_fy + fy_codes[keep],
+        "tofu": tofu.to_numpy(dtype=float, na_value=np.nan)[keep],
+        "month": month[keep],
+    })
+    agg = parts.groupby("gid", sort=False).agg(
+        tot=("tofu", "sum"), avg=("tofu", "mean"), first_month=("month", "min")
     )
-    if "to" in txt:
-        lo, hi = [float(x) for x in txt.split("to")]
-        return (lo + hi) / 2
-    if "and above" in txt:
-        return float(txt.split()[0])
-    return np.nan
 
+    first_month = agg["first_month"].to_numpy()
+    months_rem = np.where(
+        first_month >= 4, 3 - (first_month - 4), 3 + (4 - first_month)
+    )
+    # mean is NaN for all-NaN groups, which carries through to the result
+    group_vals = agg["tot"].to_numpy() + agg["avg"].to_numpy() * months_rem
 
-def _fy_label(ts: pd.Timestamp) -> str:
-    yr = ts.year + 1 if ts.month >= 4 else ts.year
-    return f"FY{str(yr)[-2:]}"
+    extrap = np.full(n_sup * n_fy, np.nan)
+    extrap[agg.index.to_numpy()] = group_vals
+
+    return pd.DataFrame(
+        extrap.reshape(n_sup, n_fy),
+        index=pd.Index(sup_uniques, name=supplier.name),
+        columns=pd.Index(fy_uniques, name="FY"),
+    )
 
 
 # ────────────────────────── main enricher ──────────────────────────
 def enrich_dataframe(df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
-    df = df.copy()  # keep caller’s df intact
+    # shallow copy: every write below is a whole-column assignment, which
+    # swaps in a new array, so the caller's data is never touched
+    df = df.copy(deep=False)
+    cols = _col_map(df)
+
+    # inputs used by more than one section are coerced once, here.  A
+    # missing borrowings column reads as 0, which both the ratio and the
+    # debt guard treat as "no borrowings" (→ NaN), as before.
+    st_borrowings = _safe_series(df, "Short term borrowings", cols, 0)
+    annual_revenue = _safe_series(df, "Annual Revenue", cols)
 
     # ---------- Cash-Rich Status ----------
-    cash_eq = _safe_series(df, "Cash and Cash Equivalents", 0)
-    invest = _safe_series(df, "Current investments", 0)
-    st_borr = _safe_series(df, "Short term borrowings").replace(0, np.nan)
-    rev_grow = _safe_series(df, "Revenue growth in %", 0)
+    cash_eq = _safe_series(df, "Cash and Cash Equivalents", cols, 0)
+    invest = _safe_series(df, "Current investments", cols, 0)
+    st_borr = st_borrowings.to_numpy(dtype=float)
+    rev_grow = _safe_series(df, "Revenue growth in %", cols, 0)
 
     rating_col = next(
-        (c for c in df.columns if c.lower() in ("latest credit ratings", "rating")), None
+        (cols[k] for k in ("latest credit ratings", "rating") if k in cols), None
     )
     rating = df[rating_col].astype(str) if rating_col else ""
 
-    ratio = (cash_eq + invest) / st_borr
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.where(st_borr != 0, (cash_eq + invest).to_numpy() / st_borr, np.nan)
     cash_rich_mask = ((ratio > 2) & (rev_grow < 15)) | rating.str.upper().str.startswith(
         "AA"
     )
     df["Cash-Rich Status"] = np.where(cash_rich_mask, "Cash-Rich", "Non-Cash Rich")
 
     # ---------- Indicative Interest Rate ----------
-    fin_cost_pct = _safe_series(df, "Finance Cost (% of Sales)") / 100
-    turnover = _safe_series(df, "Annual Revenue")
-    total_debt = (
-        _safe_series(df, "Short term borrowings", 0)
-        + _safe_series(df, "Long term borrowings", 0)
-    )
+    fin_cost_pct = _safe_series(df, "Finance Cost (% of Sales)", cols) / 100
+    turnover = annual_revenue
+    total_debt = st_borrowings + _safe_series(df, "Long term borrowings", cols, 0)
 
+    debt = total_debt.to_numpy(dtype=float)
     with np.errstate(divide="ignore", invalid="ignore"):
-        indic_rate = (fin_cost_pct * turnover) / total_debt.replace(0, np.nan) * 100
+        indic_rate = np.where(
+            debt != 0, (fin_cost_pct * turnover).to_numpy() / debt * 100, np.nan
+        )
 
-    indic_rate = indic_rate.round(2)
+    indic_rate = np.round(indic_rate, 2)
     df["Indicative Interest Rate (%)"] = np.where(
-        indic_rate.between(7, 14), indic_rate, "DATA NA"
+        (indic_rate >= 7) & (indic_rate <= 14), indic_rate, "DATA NA"
     )
 
     # ---------- Dependency % / Slab ----------
-    month_col = _get_col(df, "Month")
-    tofu_col = _get_col(df, "TOFU (in lacs)")
+    month_col = _get_col(df, "Month", cols)
+    tofu_col = _get_col(df, "TOFU (in lacs)", cols)
     month_ts = pd.to_datetime(df[month_col], errors="coerce")
-    df["FY"] = month_ts.map(_fy_label)
-    supplier_key = _get_col(df, "PAN")
-
-    def _extrap(series: pd.Series) -> float:
-        if series.count() == 0:
-            return np.nan
-        first_month = month_ts.loc[series.index].dt.month.min()
-        months_rem = 3 - (first_month - 4) if first_month >= 4 else 3 + (4 - first_month)
-        return series.sum() + series.mean() * months_rem
-
-    tofu_fy = (
-        df.groupby([supplier_key, "FY"])[tofu_col].apply(_extrap).unstack("FY")
-    )
-
-    revenue_series = _safe_series(df, "Annual Revenue", np.nan)
+    # calendar parts are pulled out once and shared by the FY labels and
+    # the extrapolation (float, so NaT → NaN)
+    month_num = month_ts.dt.month.to_numpy(dtype=float, na_value=np.nan)
+    year_num = month_ts.dt.year.to_numpy(dtype=float, na_value=np.nan)
+    df["FY"] = _fy_labels(year_num, month_num, df.index).astype("category")
+    supplier_key = _get_col(df, "PAN", cols)
+    # category codes make the supplier/FY grouping and merges hash ints, not strings
+    df[supplier_key] = df[supplier_key].astype("category")
+
+    tofu_fy = _extrap_fy(df[supplier_key], df["FY"], month_num, _to_num(df[tofu_col]))
+
+    revenue_series = annual_revenue
     if revenue_series.isna().all():
-        revenue_series = df[_get_col(df, "Turnover range")].map(_parse_slab)
-    revenue_sup = revenue_series.groupby(df[supplier_key]).first()
+        revenue_series = _parse_slab(df[_get_col(df, "Turnover range", cols)])
+    revenue_sup = revenue_series.groupby(df[supplier_key], observed=True).first()
 
     if not tofu_fy.empty:
         latest_fy = tofu_fy.columns.sort_values()[-1]
         dep_pct = (tofu_fy[latest_fy] / revenue_sup) * 100
         dep_df = pd.DataFrame({"Dependency %": dep_pct.round(2)})
-        dep_df["Dependency Slab"] = pd.cut(
-            dep_df["Dependency %"],
-            bins=[0, 25, 50, 75, 100, np.inf],
-            labels=["<25", "25–50", "50–75", "75–100", ">100"],
-            right=False,
+        # [0,25) [25,50) [50,75) [75,100) [100,∞) — same bins as pd.cut(right=False);
+        # negatives, NaN and inf get code -1 (missing)
+        dep_vals = dep_df["Dependency %"].to_numpy(dtype=float)
+        slab_codes = np.where(
+            (dep_vals >= 0) & np.isfinite(dep_vals),
+            np.searchsorted([25, 50, 75, 100], dep_vals, side="right"),
+            -1,
         )
-        df = df.merge(dep_df, left_on=supplier_key, right_index=True, how="left")
+        dep_df["Dependency Slab"] = pd.Categorical.from_codes(
+            slab_codes, categories=["<25", "25–50", "50–75", "75–100", ">100"], ordered=True
+        )
+        # per-supplier values are looked up row-wise and assigned as new
+        # columns — a left merge would rebuild (and copy) the whole frame
+        dep_rows = dep_df.reindex(df[supplier_key].to_numpy()).set_axis(df.index)
+        for c in dep_df.columns:
+            df[c] = dep_rows[c]
     else:
         df["Dependency %"] = np.nan
         df["Dependency Slab"] = np.nan
 
     # ---------- Industry Benchmarks ----------
     bench_key = next(
-        (c for c in df.columns if c.lower() in ("industry", "nature of business")),
-        None,
+        (cols[k] for k in ("industry", "nature of business") if k in cols), None
     )
     if bench_key is None:
         raise KeyError("Industry / Nature-of-Business column not found.")
@@ -170,21 +283,24 @@ def enrich_dataframe(df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
         "Inventory Days": "Avg Inventory Days",
         "Payable Days": "Avg Payable Days",
     }
-    avail_metrics: List[str] = [
-        m for m in wc_metrics if m.lower() in df.columns.str.lower()
-    ]
+    # metric name → actual column, resolved once through the lower-case map
+    metric_cols: Dict[str, str] = {
+        m: cols[m.lower()] for m in wc_metrics if m.lower() in cols
+    }
+    avail_metrics: List[str] = list(metric_cols)
 
     if avail_metrics:
         for m in avail_metrics:
-            df[_get_col(df, m)] = _to_num(df[_get_col(df, m)])
+            df[metric_cols[m]] = _to_num(df[metric_cols[m]])
 
+        df[bench_key] = df[bench_key].astype("category")
         bench_df = (
-            df[[bench_key] + [_get_col(df, m) for m in avail_metrics]]
-            .groupby(bench_key)
+            df[[bench_key] + [metric_cols[m] for m in avail_metrics]]
+            .groupby(bench_key, observed=True)
             .mean(numeric_only=True)
             .reset_index()
             .rename(
-                columns={_get_col(df, k): v for k, v in wc_metrics.items() if k in avail_metrics}
+                columns={metric_cols[m]: wc_metrics[m] for m in avail_metrics}
             )
         )
     else:
@@ -192,21 +308,76 @@ def enrich_dataframe(df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
 
     # ---------- Deviation % ----------
     if not bench_df.empty:
-        df = df.merge(bench_df, on=bench_key, how="left")
-        for metric, avg_col in wc_metrics.items():
-            if metric.lower() not in df.columns.str.lower():
-                continue
-            mcol = _get_col(df, metric)
-            acol = avg_col
-            df[mcol] = _to_num(df[mcol])
-            df[acol] = _to_num(df[acol])
-            dev_col = f"{metric} Deviation %"
-            with np.errstate(divide="ignore", invalid="ignore"):
-                df[dev_col] = ((df[mcol] - df[acol]).abs() / df[acol]) * 100
+        # same lookup trick as Dependency %: align the averages on the
+        # industry key instead of merging
+        bench_rows = (
+            bench_df.set_index(bench_key)
+            .reindex(df[bench_key].to_numpy())
+            .set_axis(df.index)
+        )
+        for m in avail_metrics:
+            df[wc_metrics[m]] = bench_rows[wc_metrics[m]]
+        present = avail_metrics
+        # metric columns were coerced to numeric above; averages come from .mean()
+        actual = df[[metric_cols[m] for m in present]].to_numpy(
+            dtype=float, na_value=np.nan
+        )
+        avg = df[[wc_metrics[m] for m in present]].to_numpy(
+            dtype=float, na_value=np.nan
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            dev = np.abs(actual - avg) / avg * 100
+        for i, metric in enumerate(present):
+            df[f"{metric} Deviation %"] = dev[:, i]
 
     return df, bench_df
 
 
+# ────────────────────────── Excel export ──────────────────────────
+def excel_with_colours(enriched_df: pd.DataFrame, bench_df: pd.DataFrame) -> BytesIO:
+    """
+    Return an in-memory XLSX where every '… Deviation %' cell is coloured:
+    ≤20 → green, 20–50 → yellow, >50 → red.
+    """
+    from xlsxwriter.utility import xl_rowcol_to_cell
+
+    buf = BytesIO()
+    wb = new_workbook(buf)
+
+    # Benchmarks sheet
+    write_sheet(wb, "Industry Benchmarks", bench_df)
+
+    # Calculations sheet
+    ws_calc = write_sheet(wb, "Calculations", enriched_df)
+
+    # pastel fills
+    fill_good = wb.add_format({"bg_color": "#C6EFCE"})   # green
+    fill_avg  = wb.add_format({"bg_color": "#FFEB9C"})   # yellow
+    fill_bad  = wb.add_format({"bg_color": "#F2DCDB"})   # red
+
+    # colour every Deviation % column via conditional formatting rules
+    # (Excel evaluates them on open; ISNUMBER keeps blanks uncoloured).
+    last_row = max(len(enriched_df), 1)
+    dev_mask = enriched_df.columns.astype(str).str.contains("Deviation %", regex=False)
+    for col_idx in dev_mask.nonzero()[0]:
+        col_idx = int(col_idx)
+        first = xl_rowcol_to_cell(1, col_idx)
+        for cond, fill in (
+            (f"{first}<=20", fill_good),
+            (f"AND({first}>20,{first}<=50)", fill_avg),
+            (f"{first}>50", fill_bad),
+        ):
+            ws_calc.conditional_format(1, col_idx, last_row, col_idx, {
+                "type": "formula",
+                "criteria": f"=AND(ISNUMBER({first}),{cond})",
+                "format": fill,
+            })
+
+    wb.close()
+    buf.seek(0)
+    return buf
+
+
 # ────────────────────────── CLI entry point ──────────────────────────
 def _cli() -> None:
     parser = argparse.ArgumentParser(
@@ -237,25 +408,16 @@ def _cli() -> None:
 
     for file_path in files:
         try:
-            df_in = (
-                pd.read_csv(file_path)
-                if file_path.lower().endswith(".csv")
-                else pd.read_excel(file_path)
-            )
+            df_in = read_table(file_path, file_path)
             enriched, bench = enrich_dataframe(df_in)
 
             base, ext = os.path.splitext(file_path)
             out_path = base + args.output_suffix
 
-            # — write Industry Benchmarks & Calculations as before —
-            with pd.ExcelWriter(out_path, engine="openpyxl") as writer:
-                wb = writer.book
-                if wb.sheetnames:
-                    del wb[wb.sheetnames[0]]
-
-                bench.to_excel(writer, sheet_name="Industry Benchmarks", index=False)
-                ws = wb.create_sheet("Calculations")
-                # … (colouring logic unchanged) …
+            # Industry Benchmarks + Calculations, Deviation % coloured by
+            # conditional-format rules rather than per-cell fills
+            with open(out_path, "wb") as fh:
+                fh.write(excel_with_colours(enriched, bench).getbuffer())
 
             print(f"✅ Processed: {os.path.basename(file_path)} → {os.path.basename(out_path)}")
         except Exception as e:
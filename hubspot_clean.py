@@ -1,7 +1,10 @@
 # contact_dedup_streamlit.py
 import streamlit as st
+import numpy as np
 import pandas as pd
-from difflib import SequenceMatcher
+from rapidfuzz import fuzz, process
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
 
 # ──────────────────────────────────────────────────────────────
 # 🧹 Contact Dedup Tool: cluster by PAN + fuzzy-name, merge rows
@@ -22,20 +25,38 @@ def normalize_phone(p: str) -> str | None:
         return f"+{digits}"
     return f"+{digits}" if digits else None
 
-def similarity(a: str, b: str) -> float:
-    return SequenceMatcher(None, a, b).ratio() * 100
-
-class UnionFind:
-    def __init__(self, n: int):
-        self.parent = list(range(n))
-    def find(self, i: int) -> int:
-        if self.parent[i] != i:
-            self.parent[i] = self.find(self.parent[i])
-        return self.parent[i]
-    def union(self, i: int, j: int) -> None:
-        ri, rj = self.find(i), self.find(j)
-        if ri != rj:
-            self.parent[rj] = ri
+def _normalize_text_series(s: pd.Series) -> pd.Series:
+    """Vectorised :func:`normalize_text`; NaN / blank → None."""
+    out = s.astype(object).astype(str).str.strip().str.lower().str.replace(r"\s+", " ", regex=True)
+    keep = (s.notna() & (out != "")).to_numpy()
+    return pd.Series(np.where(keep, out.to_numpy(dtype=object), None), index=s.index, dtype=object)
+
+def _normalize_phone_series(s: pd.Series) -> pd.Series:
+    """Vectorised :func:`normalize_phone` (non-null input)."""
+    digits = s.astype(object).astype(str).str.replace(r"\D", "", regex=True)
+    n = digits.str.len().to_numpy()
+    out = np.where(n == 10, "+91" + digits, np.where(n > 0, "+" + digits, None))
+    return pd.Series(out, index=s.index, dtype=object)
+
+def _normalize_id_series(s: pd.Series) -> pd.Series:
+    """Contact IDs as integer strings (``1001.0`` → ``"1001"``)."""
+    return pd.to_numeric(s).astype("int64").astype(str).astype(object)
+
+def _collect(df: pd.DataFrame, cols: list[str], normalise, keys: np.ndarray, n_keys: int) -> list[list]:
+    """
+    Distinct normalised values across *cols* for each cluster key.  The
+    columns are stacked into one long Series so normalising is a single
+    vectorised pass and de-duplication a single groupby, instead of a
+    Python set per row and another per cluster.
+    """
+    lists: list[list] = [[] for _ in range(n_keys)]
+    if cols:
+        long = pd.concat([df[c].reset_index(drop=True).astype(object) for c in cols])
+        long = long[long.notna() & (keys[long.index] >= 0)]
+        normed = normalise(long)
+        for key, vals in normed.groupby(keys[long.index], sort=False).unique().items():
+            lists[key] = list(vals)
+    return lists
 
 def dedupe_contacts_df(df: pd.DataFrame, threshold: float) -> pd.DataFrame:
     # strip "(No value)"
@@ -44,61 +65,70 @@ def dedupe_contacts_df(df: pd.DataFrame, threshold: float) -> pd.DataFrame:
     df['canonical_name'] = (
         df['Full Name']
         .fillna(df.get('First Name','').fillna('') + ' ' + df.get('Last Name','').fillna(''))
-        .apply(normalize_text)
+        .pipe(_normalize_text_series)
     )
     # pick up phone/email/title columns
     phone_cols = [c for c in df.columns if any(k in c.lower() for k in ('phone','mobile'))]
     email_cols = [c for c in df.columns if 'email' in c.lower()]
     title_cols = [c for c in df.columns if 'title' in c.lower() or 'designation' in c.lower()]
 
-    # aggregate into lists
-    df['phones']      = df[phone_cols].apply(lambda row: list({normalize_phone(x) for x in row if pd.notna(x)}), axis=1)
-    df['emails']      = df[email_cols].apply(lambda row: list({normalize_text(x)   for x in row if pd.notna(x)}), axis=1)
-    df['titles']      = df[title_cols].apply(lambda row: list({normalize_text(x)   for x in row if pd.notna(x)}), axis=1)
-    df['contact_ids'] = df.get('Contact ID', pd.Series()).apply(lambda x: [str(int(x))] if pd.notna(x) else [])
-
-    records = []
-    for pan, group in df.groupby('PAN Number'):
-        idxs  = group.index.tolist()
-        names = group.loc[idxs, 'canonical_name'].tolist()
-        uf    = UnionFind(len(idxs))
-
-        # fuzzy-union any pair above threshold
-        for i in range(len(idxs)):
-            if not names[i]:
-                continue
-            for j in range(i+1, len(idxs)):
-                if names[j] and similarity(names[i], names[j]) >= threshold:
-                    uf.union(i, j)
-
-        clusters: dict[int, list[int]] = {}
-        for k, idx in enumerate(idxs):
-            root = uf.find(k)
-            clusters.setdefault(root, []).append(idx)
-
-        # merge each cluster
-        for membership in clusters.values():
-            sub = df.loc[membership]
-            def pick(col: str):
-                vals = sub[col].dropna()
-                return vals.iloc[0] if not vals.empty else None
-
-            merged = {
-                'PAN Number':            pan,
-                'Company name':          pick('Company name'),
-                'Canonical Full Name':   pick('canonical_name'),
-                'Aggregated Emails':     list({e for lst in sub['emails']      for e in lst}),
-                'Aggregated Phones':     list({p for lst in sub['phones']      for p in lst}),
-                'Aggregated Titles':     list({t for lst in sub['titles']      for t in lst}),
-                'Street Address':        pick('Street Address'),
-                'State':                 pick('State'),
-                'Pincode':               pick('Pincode'),
-                'Company ID':            pick('Company ID'),
-                'Aggregated Contact IDs':list({cid for lst in sub['contact_ids'] for cid in lst}),
-            }
-            records.append(merged)
-
-    return pd.DataFrame(records)
+    # one cluster id per row, numbered PAN block by PAN block
+    cluster = np.full(len(df), -1, dtype=np.intp)   # -1: no PAN, dropped
+    n_clusters = 0
+    names_all = df['canonical_name'].tolist()
+    for positions in df.groupby('PAN Number').indices.values():
+        names = [names_all[p] for p in positions]
+        n     = len(names)
+
+        # fuzzy-link any pair above threshold — score the whole PAN block
+        # in one cdist call rather than pair by pair
+        named = np.array([k for k, nm in enumerate(names) if nm], dtype=np.intp)
+        rows = cols = np.empty(0, dtype=np.intp)
+        if len(named) > 1:
+            # identical names always score 100, so link them directly and
+            # only score the distinct names against each other
+            uniq, first, inv = np.unique([names[k] for k in named],
+                                         return_index=True, return_inverse=True)
+            rows, cols = named[first[inv]], named
+            if len(uniq) > 1:
+                scores = process.cdist(uniq.tolist(), uniq.tolist(), scorer=fuzz.ratio,
+                                       score_cutoff=threshold, workers=-1)
+                i, j = np.nonzero(np.triu(scores >= threshold, 1))
+                rows = np.concatenate([rows, named[first[i]]])
+                cols = np.concatenate([cols, named[first[j]]])
+
+        # clusters are the connected components of the match graph
+        adj = sparse.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(n, n))
+        n_comp, labels = connected_components(adj, directed=False)
+        cluster[positions] = n_clusters + labels
+        n_clusters += n_comp
+
+    # merge every cluster at once: first non-null scalar per column, and
+    # distinct values across the phone/email/title/ID columns
+    in_cluster = cluster >= 0
+    scalars = (
+        df.loc[in_cluster, ['PAN Number', 'Company name', 'canonical_name',
+                            'Street Address', 'State', 'Pincode', 'Company ID']]
+        .groupby(cluster[in_cluster])
+        .first()
+        .astype(object)
+    )
+    scalars = scalars.where(scalars.notna(), None)
+    id_cols = ['Contact ID'] if 'Contact ID' in df.columns else []
+
+    return pd.DataFrame({
+        'PAN Number':             scalars['PAN Number'].tolist(),
+        'Company name':           scalars['Company name'].tolist(),
+        'Canonical Full Name':    scalars['canonical_name'].tolist(),
+        'Aggregated Emails':      _collect(df, email_cols, _normalize_text_series,  cluster, n_clusters),
+        'Aggregated Phones':      _collect(df, phone_cols, _normalize_phone_series, cluster, n_clusters),
+        'Aggregated Titles':      _collect(df, title_cols, _normalize_text_series,  cluster, n_clusters),
+        'Street Address':         scalars['Street Address'].tolist(),
+        'State':                  scalars['State'].tolist(),
+        'Pincode':                scalars['Pincode'].tolist(),
+        'Company ID':             scalars['Company ID'].tolist(),
+        'Aggregated Contact IDs': _collect(df, id_cols, _normalize_id_series, cluster, n_clusters),
+    })
 
 def render_page() -> None:
     st.subheader("🧹 Contact Dedup Tool")
@@ -109,7 +139,7 @@ def render_page() -> None:
         return
 
     try:
-        df = pd.read_csv(input_file)
+        df = pd.read_csv(input_file, engine="pyarrow", dtype_backend="pyarrow")
     except Exception as e:
         st.error(f"Could not read CSV: {e}")
         return
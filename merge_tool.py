@@ -5,6 +5,8 @@ from typing import List, Set
 import pandas as pd
 import streamlit as st
 
+from pipeline.excel import write_xlsx
+
 # ──────────────────────────────────────────────────────────────
 # 🚀  Auto‑merge HubSpot CSV dumps into a single base Excel file
 # ----------------------------------------------------------------
@@ -40,8 +42,49 @@ UNWANTED_COLS: Set[str] = {
 # ----------------------------------------------------------------
 def _normalise_pan(series: pd.Series) -> pd.Series:
     """Trim whitespace, convert to string, and upper‑case (vectorised)."""
-    # Guard against pandas treating extension dtypes weirdly by using .apply
-    return series.apply(lambda x: str(x).strip().upper() if pd.notna(x) else x)
+    # Arrow-backed strings: one C-level pass per op, missing PANs stay <NA>
+    return series.astype("string[pyarrow]").str.strip().str.upper()
+
+
+def _to_xlsx(df: pd.DataFrame) -> BytesIO:
+    """Stream *df* into an in-memory XLSX (constant-memory xlsxwriter)."""
+    output = BytesIO()
+    write_xlsx(df, output)
+    output.seek(0)
+    return output
+
+
+def _read_hubspot_csv(path: str) -> pd.DataFrame:
+    """
+    Parse *path* with pyarrow's multithreaded CSV reader, projecting away
+    UNWANTED_COLS at read time (the header comes from the streaming
+    reader's schema, which only touches the first block).
+    """
+    import pyarrow.csv as pacsv
+
+    with pacsv.open_csv(path) as reader:
+        header = reader.schema.names
+    keep = [c for c in header if c not in UNWANTED_COLS]
+    table = pacsv.read_csv(
+        path,
+        convert_options=pacsv.ConvertOptions(include_columns=keep, strings_can_be_null=True),
+    )
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+
+@st.cache_data(show_spinner=False, max_entries=4)
+def _load_base(file_bytes: bytes) -> pd.DataFrame:
+    """Parse the uploaded base workbook once per distinct upload (keyed on its bytes)."""
+    return pd.read_excel(BytesIO(file_bytes))
+
+
+@st.cache_data(show_spinner=False)
+def _load_hubspot_csv(path: str, mtime_ns: int) -> pd.DataFrame:
+    """
+    _read_hubspot_csv, cached per (path, mtime): widget reruns skip the
+    parse for every dump that hasn't changed on disk since the last run.
+    """
+    return _read_hubspot_csv(path)
 
 
 def _find_pan_column(df: pd.DataFrame) -> str | None:
@@ -81,7 +124,7 @@ def render_page() -> None:  # noqa: C901 — function intentionally long for cla
         return
 
     try:
-        base_df = pd.read_excel(base_file)
+        base_df = _load_base(base_file.getvalue())
     except Exception as exc:
         st.error(f"❌  Could not read the Excel file: {exc}")
         return
@@ -91,7 +134,6 @@ def render_page() -> None:  # noqa: C901 — function intentionally long for cla
         return
 
     base_df["PAN"] = _normalise_pan(base_df["PAN"])
-    merged_df = base_df.copy()
 
     # 2️⃣  Discover CSVs
     st.markdown(f"🔍 Looking for CSVs in `{merge_folder}` …")
@@ -102,18 +144,18 @@ def render_page() -> None:  # noqa: C901 — function intentionally long for cla
 
     st.success(f"📑 Found {len(csv_files)} file(s): {', '.join(csv_files)}")
 
-    # 3️⃣  Merge loop — iterate through every CSV
+    # 3️⃣  Collect every CSV's new columns, then merge once
+    frames: List[pd.DataFrame] = []
+    seen_cols: Set[str] = set(base_df.columns)
+    # files are parsed on the script thread (pyarrow's reader already
+    # parallelises each parse); unchanged dumps come from the cache
     for fname in csv_files:
-        path = os.path.join(merge_folder, fname)
         try:
-            df = pd.read_csv(path)
+            path = os.path.join(merge_folder, fname)
+            df = _load_hubspot_csv(path, os.stat(path).st_mtime_ns)
 
             # Check PAN column existence
-            pan_col = None
-            for possible in ("PAN", "PAN Number"):
-                if possible in df.columns:
-                    pan_col = possible
-                    break
+            pan_col = _find_pan_column(df)
             if not pan_col:
                 st.warning(f"⚠️ Skipping {fname} — no 'PAN' or 'PAN Number' column.")
                 continue
@@ -124,22 +166,30 @@ def render_page() -> None:  # noqa: C901 — function intentionally long for cla
                 raise ValueError(f"'PAN' column is not a pandas Series in file: {fname}")
 
             # Safe PAN cleaning
-            df["PAN"] = df["PAN"].apply(lambda x: str(x).strip().upper() if pd.notna(x) else "")
-
-            # Drop contact-level junk
-            cols_to_drop = UNWANTED_COLS & set(df.columns)
-            if cols_to_drop:
-                df = df.drop(columns=list(cols_to_drop))
+            df["PAN"] = _normalise_pan(df["PAN"]).fillna("")
 
-            df = df.drop_duplicates(subset="PAN", keep="first")
+            # first row per PAN: one factorize of the Arrow strings, then the
+            # duplicate scan runs over integer codes
+            codes, _ = pd.factorize(df["PAN"])
+            df = df[~pd.Index(codes).duplicated(keep="first")]
 
-            new_cols = [c for c in df.columns if c != "PAN" and c not in merged_df.columns]
-            merged_df = merged_df.merge(df[["PAN"] + new_cols], on="PAN", how="left")
+            # earlier files (and the base) win on column-name clashes
+            new_cols = [c for c in df.columns if c != "PAN" and c not in seen_cols]
+            seen_cols.update(new_cols)
+            frames.append(df[["PAN"] + new_cols])
 
             st.success(f"✅ Merged {fname}")
         except Exception as e:
             st.error(f"❌ Error processing {fname}: {e}")
 
+    # Each file has one row per PAN, so the files line up side by side on a
+    # PAN index in one concat; the base may repeat PANs, so it is still
+    # joined with a (single) left merge
+    merged_df = base_df
+    if frames:
+        extra = pd.concat([f.set_index("PAN") for f in frames], axis=1)
+        merged_df = base_df.merge(extra, left_on="PAN", right_index=True, how="left")
+
     # 4️⃣  Optional: Re‑order columns to match the canonical schema first
     ordered_cols = [c for c in EXPECTED_COLS if c in merged_df.columns]
     remaining_cols = [c for c in merged_df.columns if c not in ordered_cols]
@@ -150,9 +200,7 @@ def render_page() -> None:  # noqa: C901 — function intentionally long for cla
     st.write("**📌 Final columns (top‑of‑mind schema reminder):**")
     st.write(merged_df.columns.tolist())
 
-    output = BytesIO()
-    merged_df.to_excel(output, index=False, engine="openpyxl")
-    output.seek(0)
+    output = _to_xlsx(merged_df)
 
     st.download_button(
         "⬇️  Download Final Merged File",
@@ -1,7 +1,68 @@
 # pipeline/calc_all.py
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+import pandas as pd
+
 from pipeline.calculations_1 import build_month_pivot
 from pipeline.calculations_2 import build_quarter_metrics
 from pipeline.calculations_3 import build_supplier_pivot
+from pipeline.excel import new_workbook, write_sheet
+
+# (progress message, sheet, builder) for every sheet this pipeline (re)builds
+STAGES = (
+    ("🧩 Creating monthly pivot sheet…", "All Metrics Pivot", build_month_pivot),
+    ("📊 Building quarterly metrics sheet…", "Quaterly Metrics", build_quarter_metrics),
+    ("📉 Creating supplier-level raw pivot…", "Quaterly Metrics wo duplicates", build_supplier_pivot),
+)
+# everything else in the workbook is kept
+OUTPUT_SHEETS = tuple(sheet for _, sheet, _ in STAGES)
+
+# group / join keys shared by all three builders
+KEY_COLS = ("PAN", "Supplier Name", "Buyer Name")
+
+
+def _read_workbook(excel_path) -> dict[str, pd.DataFrame]:
+    """Every sheet of *excel_path*, via the Rust calamine reader when installed."""
+    try:
+        return pd.read_excel(excel_path, sheet_name=None, engine="calamine")
+    except ImportError:
+        return pd.read_excel(excel_path, sheet_name=None)
+
+
+def _cache_dir(excel_path) -> Path:
+    return Path(f"{excel_path}.cache")
+
+
+def _read_cache(excel_path) -> dict[str, pd.DataFrame] | None:
+    """
+    The input sheets saved by the last run, if the workbook hasn't been
+    touched since (same mtime as when the cache was written), else None.
+    """
+    d = _cache_dir(excel_path)
+    try:
+        manifest = json.loads((d / "manifest.json").read_text())
+        if manifest["mtime_ns"] != Path(excel_path).stat().st_mtime_ns:
+            return None
+        return {name: pd.read_parquet(d / f"{i}.parquet", engine="pyarrow")
+                for i, name in enumerate(manifest["sheets"])}
+    except (OSError, ValueError, KeyError, ImportError):
+        return None
+
+
+def _write_cache(excel_path, sheets: dict[str, pd.DataFrame]) -> None:
+    """Best effort: a sheet parquet can't hold (mixed-type columns) just skips the cache."""
+    d = _cache_dir(excel_path)
+    try:
+        d.mkdir(exist_ok=True)
+        for i, sheet in enumerate(sheets.values()):
+            sheet.to_parquet(d / f"{i}.parquet", engine="pyarrow", compression="zstd")
+        manifest = {"mtime_ns": Path(excel_path).stat().st_mtime_ns, "sheets": list(sheets)}
+        (d / "manifest.json").write_text(json.dumps(manifest))
+    except Exception:
+        (d / "manifest.json").unlink(missing_ok=True)
+
 
 def run(excel_path, progress_callback=None):
     logs = []
@@ -11,14 +72,42 @@ def run(excel_path, progress_callback=None):
         if progress_callback:
             progress_callback(msg)
 
-    log("🧩 Creating monthly pivot sheet…")
-    build_month_pivot(excel_path)
+    # read the workbook once (from the parquet cache when it is unchanged
+    # since the last run), then write it back fresh in one pass: kept sheets
+    # first, then every result sheet.  xlsxwriter can't append, but with
+    # everything already in memory it doesn't need to.
+    sheets = _read_cache(excel_path)
+    if sheets is None:
+        sheets = _read_workbook(excel_path)
+    df = next(iter(sheets.values()))
+    kept = {name: sheet for name, sheet in sheets.items() if name not in OUTPUT_SHEETS}
+    # the builders group and join on these repeatedly; categoricals hash
+    # their integer codes instead of every string, and all sheets share the
+    # same categories because they start from this one frame
+    df = df.astype({c: "category" for c in KEY_COLS if c in df.columns})
+
+    # the builders only read df, and their groupbys / merges release the
+    # GIL, so they run side by side; all writes stay on this thread.  Each
+    # stage's message is logged as its builder finishes, so progress tracks
+    # the work; the sheets are still written in STAGES order.
+    with ThreadPoolExecutor(max_workers=len(STAGES)) as pool:
+        pending = {pool.submit(build, df): (msg, sheet) for msg, sheet, build in STAGES}
+        built = {}
+        for fut in as_completed(pending):
+            msg, sheet = pending[fut]
+            built[sheet] = fut.result()
+            log(msg)
+    results = [(sheet, built[sheet]) for sheet in OUTPUT_SHEETS]
 
-    log("📊 Building quarterly metrics sheet…")
-    build_quarter_metrics(excel_path)
+    wb = new_workbook(excel_path)
+    # same look as pandas' to_excel header row
+    header_fmt = wb.add_format({"bold": True, "border": 1, "align": "center", "valign": "top"})
+    for name, sheet in [*kept.items(), *results]:
+        write_sheet(wb, name, sheet, header_fmt)
+    wb.close()
 
-    log("📉 Creating supplier-level raw pivot…")
-    build_supplier_pivot(excel_path)
+    # stamped with the mtime of the workbook just written
+    _write_cache(excel_path, kept)
 
     log("✅ All sheets generated!")
 
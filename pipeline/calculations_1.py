@@ -1,15 +1,13 @@
 
 # pipeline/calculations_1.py
+import numpy as np
 import pandas as pd
-from functools import reduce
-from pathlib import Path
 
-def build_month_pivot(excel_path: str) -> None:
+def build_month_pivot(df: pd.DataFrame) -> pd.DataFrame:
     """
-    Reads *excel_path*, creates the month-level “All Metrics Pivot” sheet,
-    and writes it back (replacing if it already exists).
+    Builds the month-level “All Metrics Pivot” sheet from the source rows
+    *df* and returns it (the caller writes it to the workbook).
     """
-    df = pd.read_excel(excel_path)
 
     metrics = [
         "TOFU (in lacs)", "BOFU (in lacs)", "Buyer Revenue Share",
@@ -19,25 +17,23 @@ def build_month_pivot(excel_path: str) -> None:
         "Wtd Act Days-Calculated", "Wtd APR"
     ]
 
-    pivots = []
-    for m in metrics:
-        p = (df.pivot_table(index=["PAN", "Supplier Name", "Buyer Name"],
-                            columns="Month", values=m, aggfunc="sum")
-               .add_prefix(f"{m}__")
-               .reset_index())
-        pivots.append(p)
-
-    merged = reduce(
-        lambda l, r: pd.merge(l, r, on=["PAN", "Supplier Name", "Buyer Name"], how="outer"),
-        pivots
-    )
+    # one grouped sum over all metrics, unstacked by month (same layout as
+    # pivot_table(aggfunc="sum") but on groupby's cython sum path)
+    merged = (df.groupby(["PAN", "Supplier Name", "Buyer Name", "Month"], observed=True)[metrics]
+                .sum()
+                .unstack("Month"))
+    # grand totals in one reduction: unstack lays the columns out as a full
+    # metric × month grid, so the block reshapes to (rows, metric, month).
+    # Summing by position also means no label matching ("APR__" must not
+    # pick up "Wtd APR__…")
+    block = merged.to_numpy(dtype=float).reshape(
+        len(merged), len(metrics), len(merged.columns) // len(metrics))
+    totals = np.nansum(block, axis=2)
+
+    merged.columns = [f"{m}__{c}" for m, c in merged.columns]
+    merged = merged.reset_index()
 
     # add grand totals
-    for m in metrics:
-        merged[f"Total Sum of {m}"] = merged.filter(like=f"{m}__").sum(axis=1)
-
-    with pd.ExcelWriter(excel_path, engine="openpyxl", mode="a",
-                        if_sheet_exists="replace") as w:
-        merged.to_excel(w, sheet_name="All Metrics Pivot", index=False)
+    merged[[f"Total Sum of {m}" for m in metrics]] = totals
 
-    print("✅  All-metrics month pivot written to sheet ‘All Metrics Pivot’.")
+    return merged
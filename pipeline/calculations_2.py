@@ -1,35 +1,26 @@
 # pipeline/calculations_2.py
-import os
-from datetime import datetime
 from dateutil.relativedelta import relativedelta
+import numpy as np
 import pandas as pd
-from functools import reduce
 from pandas.tseries.offsets import DateOffset
 
+from pipeline.fiscal import add_fiscal_quarter
+
+
 # ──────────────────────────────────────────────────────────────────────────
 # 1. Locate the latest Excel inside ./Output
 # ──────────────────────────────────────────────────────────────────────────
-def build_quarter_metrics(path: str):
-    df = pd.read_excel(path)
+def build_quarter_metrics(df: pd.DataFrame) -> pd.DataFrame:
+    # shallow copy: the FY / FYQ columns added below stay local to this sheet
+    df = df.copy(deep=False)
     # … existing logic …
         # ──────────────────────────────────────────────────────────────────────────
 # 2. Create FY / FYQ (Indian fiscal Apr-Mar)
 # ──────────────────────────────────────────────────────────────────────────
     df["Month"] = pd.to_datetime(df["Month"])
 
-    def fy_label(d):
-        return f"FY{(d.year + 1 if d.month >= 4 else d.year) % 100:02d}"
-
-    def fy_quarter(d):
-        # Apr-Jun = Q1, Jul-Sep = Q2, Oct-Dec = Q3, Jan-Mar = Q4
-        if   d.month in (4, 5, 6):   return "Q1"
-        elif d.month in (7, 8, 9):   return "Q2"
-        elif d.month in (10, 11, 12):return "Q3"
-        else:                        return "Q4"
-
-    df["FY"]   = df["Month"].apply(fy_label)
-    df["Q"]    = df["Month"].apply(fy_quarter)
-    df["FYQ"]  = df["FY"] + " " + df["Q"]
+    # FY / Q / FYQ labels (undated rows get none)
+    add_fiscal_quarter(df)
 
     # The most-recent FYQ (used to tag “New”)
     latest_fyq = df.loc[df["Month"].idxmax(), "FYQ"]
@@ -43,30 +34,22 @@ def build_quarter_metrics(path: str):
         "Effective Discount (in lacs)", "Days Advanced",
         "Max Days Advanced", "APR", "Buyer Revenue Share"
     ]
+    # keep only what this sheet reads, so the row filters below copy these
+    # columns rather than the whole source sheet
+    df = df[["PAN", "Supplier Name", "Buyer Name", "Month", "FYQ", *metrics]]
 
     # ──────────────────────────────────────────────────────────────────────────
-    # 4. Pivot each metric by FYQ
+    # 4. Pivot all metrics by FYQ
     # ──────────────────────────────────────────────────────────────────────────
-    pivots = []
-    for m in metrics:
-        piv = (
-            df.pivot_table(index=["PAN", "Supplier Name", "Buyer Name"],
-                        columns="FYQ", values=m, aggfunc="sum")
-            .sort_index(axis=1)
-        )
+    fyq_sums = df.groupby(["PAN", "Supplier Name", "Buyer Name", "FYQ"], observed=True)[metrics].sum()
+    merged = fyq_sums.unstack("FYQ")
 
-        # Rename columns using strftime (assuming FYQ is a datetime column)
-        # Make the pivot-column label usable in Excel:
-        # e.g.  "FY25 Q1"  →  "FY25_Q1"
-        piv.columns = [f"{m}__{str(col).replace(' ', '_')}" for col in piv.columns]
-
-
-        piv = piv.reset_index()
-        pivots.append(piv)
-
-    # Combine all pivots
-    merged = reduce(lambda l, r: pd.merge(l, r, on=["PAN", "Supplier Name", "Buyer Name"], how="outer"),
-                    pivots)
+    # Make the pivot-column label usable in Excel:
+    # e.g.  "FY25 Q1"  →  "FY25_Q1"
+    merged.columns = [f"{m}__{str(col).replace(' ', '_')}" for m, col in merged.columns]
+    merged = merged.reset_index()
+    # row keys of merged, for aligning per-key Series onto it without a merge
+    rows = pd.MultiIndex.from_frame(merged[["PAN", "Supplier Name", "Buyer Name"]])
 
     # ──────────────────────────────────────────────────────────────────────────
     # 5. First / Last quarter, counts, acceleration
@@ -76,36 +59,48 @@ def build_quarter_metrics(path: str):
             "12": last_month - relativedelta(months=12),
             "6":  last_month - relativedelta(months=6)}
 
+    # One grouped pass for all three windows: each row gets the number of
+    # cutoffs it is on or after (0 = older than 18M, 3 = inside the last 6M),
+    # and newest-first running totals over that ordinal give the nested
+    # 6M / 12M / 18M windows
+    window = sum((df["Month"] >= c).astype(int) for c in cuts.values())
+    fields = ["rows", "tofu_nz", "tofu", "bofu"]
+    by_window = (df.assign(window=window, tofu_nz=df["TOFU (in lacs)"].ne(0))
+                   .groupby(["PAN", "Supplier Name", "Buyer Name", "window"], observed=True)
+                   .agg(rows=("tofu_nz", "size"), tofu_nz=("tofu_nz", "sum"),
+                        tofu=("TOFU (in lacs)", "sum"), bofu=("BOFU (in lacs)", "sum"))
+                   .unstack("window", fill_value=0)
+                   .reindex(columns=pd.MultiIndex.from_product([fields, range(4)]), fill_value=0))
+    in_window = {f: by_window[f].iloc[:, ::-1].cumsum(axis=1).reindex(rows) for f in fields}
+    # window ordinal each label starts at; keys with no rows in it stay NaN
+    starts = {"18": 1, "12": 2, "6": 3}
+
     # helper: add first/last quarter & counts
     for m in ["TOFU (in lacs)", "BOFU (in lacs)"]:
-        q_cols = merged.filter(like=f"{m}__").columns
-
-        merged[f"First {m} Quarter"] = merged[q_cols].apply(
-            lambda r: next((c.split("__")[1] for c in q_cols if pd.notna(r[c]) and r[c]!=0), pd.NA), axis=1)
-        merged[f"Last {m} Quarter"] = merged[q_cols].apply(
-            lambda r: next((c.split("__")[1] for c in reversed(q_cols) if pd.notna(r[c]) and r[c]!=0), pd.NA), axis=1)
+        # first / last quarter with a non-zero value: min / max FYQ over the
+        # long (key, FYQ) sums ("FY25 Q2" labels sort chronologically)
+        nz_fyq = fyq_sums.index.to_frame(index=False)[(fyq_sums[m] != 0).to_numpy()]
+        span = (nz_fyq.groupby(["PAN", "Supplier Name", "Buyer Name"], observed=True)["FYQ"]
+                      .agg(["min", "max"])
+                      .reindex(rows))
+        merged[f"First {m} Quarter"] = span["min"].str.replace(" ", "_").to_numpy()
+        merged[f"Last {m} Quarter"] = span["max"].str.replace(" ", "_").to_numpy()
 
         # TOFU counts
         if m == "TOFU (in lacs)":
-            for lbl, cutoff in cuts.items():
-                cnt = (df[df["Month"] >= cutoff]
-                    .groupby(["PAN", "Supplier Name", "Buyer Name"])[m]
-                    .apply(lambda s: (s!=0).sum())
-                    .rename(f"{m} count {lbl} month"))
-                merged = merged.merge(cnt.reset_index(), how="left",
-                                    on=["PAN", "Supplier Name", "Buyer Name"])
+            for lbl, k in starts.items():
+                present = in_window["rows"][k] > 0
+                cnt = in_window["tofu_nz"][k].where(present)
+                merged[f"{m} count {lbl} month"] = cnt.to_numpy()
 
         # BOFU / TOFU acceleration
         if m == "BOFU (in lacs)":
-            for lbl, cutoff in cuts.items():
-                tofu = (df[df["Month"] >= cutoff]
-                        .groupby(["PAN", "Supplier Name", "Buyer Name"])["TOFU (in lacs)"].sum())
-                bofu = (df[df["Month"] >= cutoff]
-                        .groupby(["PAN", "Supplier Name", "Buyer Name"])["BOFU (in lacs)"].sum())
+            for lbl, k in starts.items():
+                present = in_window["rows"][k] > 0
+                tofu = in_window["tofu"][k]
+                bofu = in_window["bofu"][k]
                 acc  = (bofu / tofu).replace([float("inf"), -float("inf")], 0).fillna(0)
-                merged = merged.merge(acc.rename(f"Acc Rate {lbl} month").reset_index(),
-                                    how="left",
-                                    on=["PAN", "Supplier Name", "Buyer Name"])
+                merged[f"Acc Rate {lbl} month"] = acc.where(present).to_numpy()
 
     # ──────────────────────────────────────────────────────────────────────────
     # 6. Dynamic categorisation using latest FYQ
@@ -115,85 +110,76 @@ def build_quarter_metrics(path: str):
         Pure TOFU-side tag: Regular / Medium / Low / New.
         (No churn logic here – churn is driven by BOFU behaviour.)
         """
-        if pd.isna(first_qtr):
-            return "TOFU Low"
-        if first_qtr == latest_fyq:
-            return "TOFU New"
-        if cnt >= hi:
-            return "TOFU Regular"
-        if cnt >= mid:
-            return "TOFU Medium"
-        return "TOFU Low"
-    # Helper to know “last three TOFU months”
-    last_three_tofu = (
-        df[df["TOFU (in lacs)"] > 0]
-        .groupby(["PAN", "Supplier Name"])["Month"]
-        .nlargest(3)
-        .reset_index(level=2, drop=True)
-    )
+        return np.select(
+            [first_qtr.isna(), first_qtr.eq(latest_fyq), cnt >= hi, cnt >= mid],
+            ["TOFU Low", "TOFU New", "TOFU Regular", "TOFU Medium"],
+            default="TOFU Low",
+        )
+
 
     def bofu_cat(first_qtr, acc,
                 last_bofu_qtr,
                 n_tofu_instances,
-                last_three_tofu_months):
-
-        # 0) Never transacted
-        if pd.isna(first_qtr):
-            # Distinguish new-TOFU vs old-TOFU
-            if n_tofu_instances and last_three_tofu_months.max() >= last_month - DateOffset(months=8):
-                return "Not Txn – New TOFU"
-            else:
-                return "Not Txn – Old TOFU"
-
-        # 1) BOFU happened in latest FYQ ⇒ New
-        if first_qtr == latest_fyq:
-            return "Txn New"
-
-        # 2) Normal tiers
-        if acc >= 0.8:
-            return "Txn High"
-        if acc >= 0.5:
-            return "Txn Med"
-        if acc > 0:
-            # --- churn / at-risk logic -------------
-            # No BOFU in the last 3 TOFU instances
-            if last_bofu_qtr is not None:
-                months_since_last_bofu = (last_month - last_bofu_qtr).days / 30
-                if months_since_last_bofu > 12:
-                    return "Churned >1 yr"
-                else:
-                    return "Churned <1 yr"
-
-            # If last two TOFU arrivals had zero BOFU
-            if n_tofu_instances >= 2 and acc == 0:
-                return "At-risk of Churn"
-
-            return "Txn Low"
-
-        # No revenue share at all
-        return "Not Txn"
-
-    merged["TOFU Category_18M"] = merged.apply(
-        lambda r: tofu_cat(r["First TOFU (in lacs) Quarter"], r.get("TOFU (in lacs) count 18 month", 0), 13, 7), axis=1)
-    merged["TOFU Category_12M"] = merged.apply(
-        lambda r: tofu_cat(r["First TOFU (in lacs) Quarter"], r.get("TOFU (in lacs) count 12 month", 0), 9, 5), axis=1)
-    merged["TOFU Category_6M"]  = merged.apply(
-        lambda r: tofu_cat(r["First TOFU (in lacs) Quarter"], r.get("TOFU (in lacs) count 6 month", 0), 5, 3), axis=1)
-
-    merged["BOFU Category_18M"] = merged.apply(
-        lambda r: bofu_cat(r["First BOFU (in lacs) Quarter"], r.get("Acc Rate 18 month", 0)), axis=1)
-    merged["BOFU Category_12M"] = merged.apply(
-        lambda r: bofu_cat(r["First BOFU (in lacs) Quarter"], r.get("Acc Rate 12 month", 0)), axis=1)
-    merged["BOFU Category_6M"]  = merged.apply(
-        lambda r: bofu_cat(r["First BOFU (in lacs) Quarter"], r.get("Acc Rate 6 month", 0)), axis=1)
+                last_tofu_month):
+        no_txn = first_qtr.isna()
+        # No BOFU in the last 3 TOFU instances
+        months_since_last_bofu = (last_month - last_bofu_qtr).dt.days / 30
+        return np.select(
+            [
+                # 0) Never transacted – distinguish new-TOFU vs old-TOFU
+                no_txn & (n_tofu_instances > 0)
+                       & (last_tofu_month >= last_month - DateOffset(months=8)),
+                no_txn,
+                # 1) BOFU happened in latest FYQ ⇒ New
+                first_qtr.eq(latest_fyq),
+                # 2) Normal tiers
+                acc >= 0.8,
+                acc >= 0.5,
+                # --- churn logic -------------
+                (acc > 0) & last_bofu_qtr.notna() & (months_since_last_bofu > 12),
+                (acc > 0) & last_bofu_qtr.notna(),
+                acc > 0,
+            ],
+            ["Not Txn – New TOFU", "Not Txn – Old TOFU", "Txn New",
+             "Txn High", "Txn Med", "Churned >1 yr", "Churned <1 yr", "Txn Low"],
+            # No revenue share at all
+            default="Not Txn",
+        )
+
+    # Churn lookups are per supplier (as in the supplier-level sheet) and are
+    # broadcast onto every (PAN, Supplier, Buyer) row of merged.
+    keys = pd.MultiIndex.from_frame(merged[["PAN", "Supplier Name"]])
+    tofu_months = df[df["TOFU (in lacs)"] > 0].groupby(["PAN", "Supplier Name"], observed=True)["Month"]
+
+    # Last BOFU month per supplier
+    last_bofu_month = (
+        df[df["BOFU (in lacs)"] > 0]
+        .groupby(["PAN", "Supplier Name"], observed=True)["Month"]
+        .max()
+        .reindex(keys)
+        .set_axis(merged.index)
+    )
+
+    # TOFU instance count (distinct months, all time) and most recent TOFU month
+    tofu_instance_count = tofu_months.nunique().reindex(keys, fill_value=0).set_axis(merged.index)
+    last_tofu_month = tofu_months.max().reindex(keys).set_axis(merged.index)
+
+    for lbl, (hi, mid) in {"18": (13, 7), "12": (9, 5), "6": (5, 3)}.items():
+        merged[f"TOFU Category_{lbl}M"] = tofu_cat(
+            merged["First TOFU (in lacs) Quarter"],
+            merged[f"TOFU (in lacs) count {lbl} month"], hi, mid)
+
+    for lbl in ("18", "12", "6"):
+        merged[f"BOFU Category_{lbl}M"] = bofu_cat(
+            merged["First BOFU (in lacs) Quarter"],
+            merged[f"Acc Rate {lbl} month"],
+            last_bofu_month, tofu_instance_count, last_tofu_month)
 
     # ──────────────────────────────────────────────────────────────────────────
-    # 7. Write sheet “Quarterly Metrics”
+    # 7. Hand back sheet “Quarterly Metrics” (calc_all writes it)
     # ──────────────────────────────────────────────────────────────────────────
 
-    with pd.ExcelWriter(path, engine="openpyxl", mode="a",
-                        if_sheet_exists="replace") as w:
-        merged.to_excel(w, sheet_name="Quaterly Metrics", index=False)
+    return merged
 
 
 # with pd.ExcelWriter(file_path, engine="openpyxl", mode="a", if_sheet_exists="replace") as writer:
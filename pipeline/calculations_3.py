@@ -1,22 +1,20 @@
-import os
-from datetime import datetime
 from dateutil.relativedelta import relativedelta
+import numpy as np
 import pandas as pd
-from functools import reduce
 from pandas.tseries.offsets import DateOffset
 
-def build_supplier_pivot(path: str):
-    raw = pd.read_excel(path)
+from pipeline.fiscal import add_fiscal_quarter
+
+
+def build_supplier_pivot(df: pd.DataFrame) -> pd.DataFrame:
+    # shallow copy: the FY / FYQ columns added below stay local to this sheet
+    raw = df.copy(deep=False)
     # … existing logic …
     # ── 2. Add FY + FYQ (Indian fiscal Apr-Mar) ───────────────────────────────
     raw["Month"] = pd.to_datetime(raw["Month"])
 
-    def fy_label(d):   return f"FY{(d.year+1 if d.month>=4 else d.year)%100:02d}"
-    def fy_quarter(d): return ["Q4","Q1","Q1","Q1","Q2","Q2","Q2","Q3","Q3","Q3","Q4","Q4"][d.month-1]
-
-    raw["FY"]  = raw["Month"].apply(fy_label)
-    raw["Q"]   = raw["Month"].apply(fy_quarter)
-    raw["FYQ"] = raw["FY"] + " " + raw["Q"]
+    # FY / Q / FYQ labels (undated rows get none)
+    add_fiscal_quarter(raw)
     latest_fyq = raw.loc[raw["Month"].idxmax(), "FYQ"]
     print("✨ Latest FY-Quarter:", latest_fyq)
 
@@ -29,21 +27,17 @@ def build_supplier_pivot(path: str):
 
     # ── 4. Supplier-level aggregation but keep Month & FYQ ────────────────────
     supplier_df = (
-        raw.groupby(["PAN", "Supplier Name", "Month", "FYQ"], as_index=False)[metrics]
+        raw.groupby(["PAN", "Supplier Name", "Month", "FYQ"], as_index=False, observed=True)[metrics]
             .sum()
     )
 
-    # ── 5. Build a pivot per metric (rows = supplier, cols = FYQ) ────────────
-    pivots = []
-    for m in metrics:
-        p = (supplier_df.pivot_table(index=["PAN", "Supplier Name"],
-                                    columns="FYQ", values=m, aggfunc="sum")
-            .sort_index(axis=1)
-            .add_prefix(f"{m}__")
-            .reset_index())
-        pivots.append(p)
-
-    merged = reduce(lambda l,r: pd.merge(l,r,on=["PAN","Supplier Name"], how="outer"), pivots)
+    # ── 5. One pivot over all metrics (rows = supplier, cols = FYQ) ─────────
+    fyq_sums = supplier_df.groupby(["PAN", "Supplier Name", "FYQ"], observed=True)[metrics].sum()
+    merged = fyq_sums.unstack("FYQ")
+    merged.columns = [f"{m}__{q}" for m, q in merged.columns]
+    merged = merged.reset_index()
+    # row keys of merged, for aligning per-supplier Series onto it
+    keys = pd.MultiIndex.from_frame(merged[["PAN", "Supplier Name"]])
 
     # ── 6. Counts + acceleration (use original supplier_df) ──────────────────
     last_month = raw["Month"].max()
@@ -51,154 +45,118 @@ def build_supplier_pivot(path: str):
             "12": last_month - relativedelta(months=12),
             "6":  last_month - relativedelta(months=6)}
 
-    # helper: TOFU counts & BOFU/TOFU acc
-    for lbl, cutoff in cuts.items():
+    # one grouped pass for all three windows: window = number of cutoffs the
+    # month is on or after (0 = older than 18M, 3 = last 6M); newest-first
+    # running totals over it give the nested 6M / 12M / 18M windows
+    window = sum((supplier_df["Month"] >= c).astype(int) for c in cuts.values())
+    fields = ["rows", "non_zero", "BOFU (in lacs)", "TOFU (in lacs)"]
+    by_window = (supplier_df.assign(window=window, non_zero=supplier_df["TOFU (in lacs)"].ne(0))
+                 .groupby(["PAN", "Supplier Name", "window"], observed=True)
+                 .agg(**{"rows": ("non_zero", "size"), "non_zero": ("non_zero", "sum"),
+                         "BOFU (in lacs)": ("BOFU (in lacs)", "sum"),
+                         "TOFU (in lacs)": ("TOFU (in lacs)", "sum")})
+                 .unstack("window", fill_value=0)
+                 .reindex(columns=pd.MultiIndex.from_product([fields, range(4)]), fill_value=0))
+    in_window = {f: by_window[f].iloc[:, ::-1].cumsum(axis=1).reindex(keys) for f in fields}
+
+    # helper: TOFU counts & BOFU/TOFU acc (suppliers with no months in a
+    # window stay NaN)
+    for lbl, k in {"18": 1, "12": 2, "6": 3}.items():
+        present = in_window["rows"][k] > 0
+
         # TOFU non-zero month count
-        cnt = (supplier_df[supplier_df["Month"] >= cutoff]
-            .assign(non_zero=lambda d: d["TOFU (in lacs)"].ne(0))
-            .groupby(["PAN","Supplier Name"])["non_zero"].sum()
-            .rename(f"TOFU (in lacs) count {lbl} month"))
-        merged = merged.merge(cnt.reset_index(), on=["PAN","Supplier Name"], how="left")
+        cnt = in_window["non_zero"][k].where(present)
+        merged[f"TOFU (in lacs) count {lbl} month"] = cnt.to_numpy()
 
         # Acc rate = BOFU / TOFU for the window
-        sums = (supplier_df[supplier_df["Month"] >= cutoff]
-                .groupby(["PAN","Supplier Name"])[["BOFU (in lacs)","TOFU (in lacs)"]]
-                .sum())
-        acc = (sums["BOFU (in lacs)"] / sums["TOFU (in lacs)"]).replace([pd.NA, float("inf")], 0).fillna(0)
-        merged = merged.merge(acc.rename(f"Acc Rate {lbl} month").reset_index(),
-                            on=["PAN","Supplier Name"], how="left")
+        acc = (in_window["BOFU (in lacs)"][k] / in_window["TOFU (in lacs)"][k]).replace([pd.NA, float("inf")], 0).fillna(0)
+        merged[f"Acc Rate {lbl} month"] = acc.where(present).to_numpy()
 
     # ── 7. First / last FYQ with data for TOFU & BOFU ─────────────────────────
     for m in ["TOFU (in lacs)", "BOFU (in lacs)"]:
-        cols = merged.filter(like=f"{m}__").columns
-        merged[f"First {m} Quarter"] = merged[cols].apply(
-            lambda r: next((c.split("__")[1] for c in cols if pd.notna(r[c]) and r[c]!=0), pd.NA), axis=1)
-        merged[f"Last {m} Quarter"]  = merged[cols].apply(
-            lambda r: next((c.split("__")[1] for c in reversed(cols) if pd.notna(r[c]) and r[c]!=0), pd.NA), axis=1)
-
-    # ── 8. Categorisation helpers ────────────────────────────────────────────
+        # min / max over the long (supplier, FYQ) sums; FYQ strings sort
+        # chronologically
+        nz_fyq = fyq_sums.index.to_frame(index=False)[(fyq_sums[m] != 0).to_numpy()]
+        span = (nz_fyq.groupby(["PAN", "Supplier Name"], observed=True)["FYQ"]
+                      .agg(["min", "max"])
+                      .reindex(keys))
+        merged[f"First {m} Quarter"] = span["min"].to_numpy()
+        merged[f"Last {m} Quarter"]  = span["max"].to_numpy()
+
+    # ── 8. Categorisation helpers (vectorised over whole columns) ─────────────
     def tofu_cat(first_qtr, cnt, hi, mid):
         """
         Pure TOFU-side tag: Regular / Medium / Low / New.
         (No churn logic here – churn is driven by BOFU behaviour.)
         """
-        if pd.isna(first_qtr):
-            return "TOFU Low"
-        if first_qtr == latest_fyq:
-            return "TOFU New"
-        if cnt >= hi:
-            return "TOFU Regular"
-        if cnt >= mid:
-            return "TOFU Medium"
-        return "TOFU Low"
-
-
-    # Helper to know “last three TOFU months”
-    last_three_tofu = (
-        supplier_df[supplier_df["TOFU (in lacs)"] > 0]
-        .groupby(["PAN", "Supplier Name"])["Month"]
-        .nlargest(3)
-        .reset_index(level=2, drop=True)
-    )
+        return np.select(
+            [first_qtr.isna(), first_qtr.eq(latest_fyq), cnt >= hi, cnt >= mid],
+            ["TOFU Low", "TOFU New", "TOFU Regular", "TOFU Medium"],
+            default="TOFU Low",
+        )
+
 
     def bofu_cat(first_qtr, acc,
                 last_bofu_qtr,
                 n_tofu_instances,
-                last_three_tofu_months):
-
-        # 0) Never transacted
-        if pd.isna(first_qtr):
-            # Distinguish new-TOFU vs old-TOFU
-            if n_tofu_instances and last_three_tofu_months.max() >= last_month - DateOffset(months=8):
-                return "Not Txn – New TOFU"
-            else:
-                return "Not Txn – Old TOFU"
-
-        # 1) BOFU happened in latest FYQ ⇒ New
-        if first_qtr == latest_fyq:
-            return "Txn New"
-
-        # 2) Normal tiers
-        if acc >= 0.8:
-            return "Txn High"
-        if acc >= 0.5:
-            return "Txn Med"
-        if acc > 0:
-            # --- churn / at-risk logic -------------
-            # No BOFU in the last 3 TOFU instances
-            if last_bofu_qtr is not None:
-                months_since_last_bofu = (last_month - last_bofu_qtr).days / 30
-                if months_since_last_bofu > 12:
-                    return "Churned >1 yr"
-                else:
-                    return "Churned <1 yr"
-
-            # If last two TOFU arrivals had zero BOFU
-            if n_tofu_instances >= 2 and acc == 0:
-                return "At-risk of Churn"
-
-            return "Txn Low"
-
-        # No revenue share at all
-        return "Not Txn"
+                last_tofu_month):
+        no_txn = first_qtr.isna()
+        # No BOFU in the last 3 TOFU instances
+        months_since_last_bofu = (last_month - last_bofu_qtr).dt.days / 30
+        return np.select(
+            [
+                # 0) Never transacted – distinguish new-TOFU vs old-TOFU
+                no_txn & (n_tofu_instances > 0)
+                       & (last_tofu_month >= last_month - DateOffset(months=8)),
+                no_txn,
+                # 1) BOFU happened in latest FYQ ⇒ New
+                first_qtr.eq(latest_fyq),
+                # 2) Normal tiers
+                acc >= 0.8,
+                acc >= 0.5,
+                # --- churn logic -------------
+                (acc > 0) & last_bofu_qtr.notna() & (months_since_last_bofu > 12),
+                (acc > 0) & last_bofu_qtr.notna(),
+                acc > 0,
+            ],
+            ["Not Txn – New TOFU", "Not Txn – Old TOFU", "Txn New",
+             "Txn High", "Txn Med", "Churned >1 yr", "Churned <1 yr", "Txn Low"],
+            # No revenue share at all
+            default="Not Txn",
+        )
 
 
     # -------------------------------------------------------------------------
-    # Build lookup tables for churn logic
+    # Build lookup tables for churn logic (aligned to merged's rows)
     # -------------------------------------------------------------------------
+    tofu_months = supplier_df[supplier_df["TOFU (in lacs)"] > 0].groupby(["PAN", "Supplier Name"], observed=True)["Month"]
+
     # Last BOFU month per supplier
     last_bofu_month = (
         supplier_df[supplier_df["BOFU (in lacs)"] > 0]
-        .groupby(["PAN", "Supplier Name"])["Month"]
+        .groupby(["PAN", "Supplier Name"], observed=True)["Month"]
         .max()
+        .reindex(keys)
+        .set_axis(merged.index)
     )
 
-    # TOFU instance count (all time)
-    tofu_instance_count = (
-        supplier_df[supplier_df["TOFU (in lacs)"] > 0]
-        .groupby(["PAN", "Supplier Name"])["Month"]
-        .count()
-    )
+    # TOFU instance count (all time) and most recent TOFU month
+    tofu_instance_count = tofu_months.count().reindex(keys, fill_value=0).set_axis(merged.index)
+    last_tofu_month = tofu_months.max().reindex(keys).set_axis(merged.index)
 
     # -------------------------------------------------------------------------
     # Apply categorisation
     # -------------------------------------------------------------------------
-    merged["TOFU Category_18M"] = merged.apply(
-        lambda r: tofu_cat(r["First TOFU (in lacs) Quarter"],
-                        r.get("TOFU (in lacs) count 18 month", 0), 13, 7), axis=1)
-
-    merged["TOFU Category_12M"] = merged.apply(
-        lambda r: tofu_cat(r["First TOFU (in lacs) Quarter"],
-                        r.get("TOFU (in lacs) count 12 month", 0), 9, 5), axis=1)
-
-    merged["TOFU Category_6M"] = merged.apply(
-        lambda r: tofu_cat(r["First TOFU (in lacs) Quarter"],
-                        r.get("TOFU (in lacs) count 6 month", 0), 5, 3), axis=1)
-
-    merged["BOFU Category_18M"] = merged.apply(
-        lambda r: bofu_cat(r["First BOFU (in lacs) Quarter"],
-                        r.get("Acc Rate 18 month", 0),
-                        last_bofu_month.get((r["PAN"], r["Supplier Name"])),
-                        tofu_instance_count.get((r["PAN"], r["Supplier Name"]), 0),
-                        last_three_tofu.get((r["PAN"], r["Supplier Name"]))),
-        axis=1)
-
-    merged["BOFU Category_12M"] = merged.apply(
-        lambda r: bofu_cat(r["First BOFU (in lacs) Quarter"],
-                        r.get("Acc Rate 12 month", 0),
-                        last_bofu_month.get((r["PAN"], r["Supplier Name"])),
-                        tofu_instance_count.get((r["PAN"], r["Supplier Name"]), 0),
-                        last_three_tofu.get((r["PAN"], r["Supplier Name"]))),
-        axis=1)
-
-    merged["BOFU Category_6M"] = merged.apply(
-        lambda r: bofu_cat(r["First BOFU (in lacs) Quarter"],
-                        r.get("Acc Rate 6 month", 0),
-                        last_bofu_month.get((r["PAN"], r["Supplier Name"])),
-                        tofu_instance_count.get((r["PAN"], r["Supplier Name"]), 0),
-                        last_three_tofu.get((r["PAN"], r["Supplier Name"]))),
-        axis=1)
-
-    with pd.ExcelWriter(path, engine="openpyxl", mode="a",
-                        if_sheet_exists="replace") as w:
-        merged.to_excel(w, sheet_name="Quaterly Metrics wo duplicates", index=False)
+    for lbl, (hi, mid) in {"18": (13, 7), "12": (9, 5), "6": (5, 3)}.items():
+        merged[f"TOFU Category_{lbl}M"] = tofu_cat(
+            merged["First TOFU (in lacs) Quarter"],
+            merged[f"TOFU (in lacs) count {lbl} month"], hi, mid)
+
+    for lbl in ("18", "12", "6"):
+        merged[f"BOFU Category_{lbl}M"] = bofu_cat(
+            merged["First BOFU (in lacs) Quarter"],
+            merged[f"Acc Rate {lbl} month"],
+            last_bofu_month, tofu_instance_count, last_tofu_month)
+
+    # sheet "Quaterly Metrics wo duplicates" (written by calc_all)
+    return merged
@@ -1,40 +1,160 @@
+import hashlib
 import os
+import threading
+import time
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from sqlalchemy import create_engine
+import psycopg2.extensions as pgext
+from sqlalchemy import create_engine, event
 from textwrap import dedent
 from dotenv import load_dotenv
 
+from pipeline.excel import write_xlsx
+
 # Load environment variables from .env
 load_dotenv()
 
+# numeric → float at the driver, instead of one Decimal object per cell
+_DEC2FLOAT = pgext.new_type(
+    pgext.DECIMAL.values, "DEC2FLOAT", lambda v, cur: float(v) if v is not None else None
+)
+
+
+def _numeric_as_float(dbapi_conn, _record) -> None:
+    """Engine "connect" hook: register the float caster on this connection only."""
+    pgext.register_type(_DEC2FLOAT, dbapi_conn)
+
+_ENGINE = None
+_ENGINE_LOCK = threading.Lock()
+
+
+def _get_engine():
+    """
+    The module's SQLAlchemy engine, created on first use and then shared by
+    every run() so repeated pulls reuse warm pooled connections instead of
+    paying the connect / TLS / auth handshake each time.
+    """
+    global _ENGINE
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            PG_USER = os.getenv("PG_USER")
+            PG_PASSWORD = os.getenv("PG_PASSWORD")
+            PG_HOST = os.getenv("PG_HOST")
+            PG_DB = os.getenv("PG_DB")
+
+            if not all([PG_USER, PG_PASSWORD, PG_HOST, PG_DB]):
+                raise EnvironmentError("One or more PostgreSQL credentials are missing in the environment.")
+
+            engine = create_engine(
+                f"postgresql+psycopg2://{PG_USER}:{PG_PASSWORD}@{PG_HOST}/{PG_DB}",
+                connect_args={"options": "-c statement_timeout=0"},
+                pool_size=4,
+                pool_pre_ping=True,   # drop connections the server closed while idle
+                pool_recycle=1800,
+            )
+            event.listen(engine, "connect", _numeric_as_float)
+            _ENGINE = engine
+        return _ENGINE
+
+
+def _read_query(query, engine, params: dict | None = None) -> pd.DataFrame:
+    """
+    Run *query* (with bind *params*, if any) and return its result with Arrow-backed dtypes.
+    stream_results makes psycopg2 use a server-side cursor, so rows arrive
+    in batches instead of one client-side buffer.  Each batch goes column by
+    column straight into Arrow arrays (types inferred in C, nullable ints /
+    bools kept as int64 / bool), with no intermediate pandas frame.
+    """
+    import pyarrow as pa
+
+    with engine.connect().execution_options(stream_results=True) as conn:
+        # plain SQL strings go to the driver as-is, like read_sql_query does
+        if isinstance(query, str):
+            result = conn.exec_driver_sql(query)
+        else:
+            result = conn.execute(query, params or {})
+        names = list(result.keys())
+        fields = [str(i) for i in range(len(names))]   # result names may repeat
+        batches = [
+            pa.Table.from_arrays([pa.array(col) for col in zip(*rows)], names=fields)
+            for rows in result.partitions(50_000)
+        ]
+    if not batches:
+        batches = [pa.Table.from_arrays([pa.array([])] * len(fields), names=fields)]
+    # a batch whose column is all NULL is typed null; promote it to the others'
+    table = pa.concat_tables(batches, promote_options="permissive").rename_columns(names)
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
+
+
+def _join_request_summary(vendor: pd.DataFrame, reqsum: pd.DataFrame) -> pd.DataFrame:
+    """
+    Left-join the per-(Partner ID, Month) revenue summary onto the vendor
+    rows, derive its weighted field and put the columns back in the
+    report's order, without the Partner ID join key.
+    """
+    df = vendor.merge(reqsum, on=["Partner ID", "Month"], how="left")
+    df["Wtd Buyer Rev Share"] = df["TOFU (in lacs)"] * df["Buyer Revenue Share (in lacs)"]
+    cols = list(vendor.columns.drop("Partner ID"))
+    at = cols.index("Acc Rate") + 1
+    cols[at:at] = ["Platform Fee (in lacs)", "Buyer Revenue Share (in lacs)"]
+    return df[cols + ["Wtd Buyer Rev Share"]]
+
+
+def _read_query_cache(path: str, ttl: float) -> pd.DataFrame | None:
+    """The cached query result at *path* if it is younger than *ttl* seconds, else None."""
+    try:
+        if time.time() - os.path.getmtime(path) >= ttl:
+            return None
+        return pd.read_parquet(path, engine="pyarrow")
+    except (OSError, ValueError, ImportError):
+        return None
+
+
+def _write_query_cache(path: str, df: pd.DataFrame) -> None:
+    """Best effort: a result parquet can't hold just skips the cache."""
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        df.to_parquet(path, engine="pyarrow", compression="zstd", index=False)
+    except Exception:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
 def run(
     months_back: int   = 6,
     out_dir:    str    = "Output",
+    out_format: str    = "xlsx",
+    cache_ttl:  float  = 900,
     **kwargs,
 ) -> str:
-    """Return the path to the freshly-written Excel file."""
-    # 1) Load database credentials from environment
-    PG_USER = os.getenv("PG_USER")
-    PG_PASSWORD = os.getenv("PG_PASSWORD")
-    PG_HOST = os.getenv("PG_HOST")
-    PG_DB = os.getenv("PG_DB")
-
-    if not all([PG_USER, PG_PASSWORD, PG_HOST, PG_DB]):
-        raise EnvironmentError("One or more PostgreSQL credentials are missing in the environment.")
+    """
+    Return the path to the freshly-written output file: an Excel workbook
+    by default (what calc_all and the dashboard read), or a zstd Parquet
+    file with ``out_format="parquet"`` for pandas / Arrow consumers.
+
+    The raw query result is kept under ``<out_dir>/.cache`` keyed by a hash
+    of the SQL (which embeds the cutoff date); runs within *cache_ttl*
+    seconds of it reuse that instead of querying again.  ``cache_ttl=0``
+    always queries.
+    """
+    if out_format not in ("xlsx", "parquet"):
+        raise ValueError(f"Unsupported out_format: {out_format!r} (use 'xlsx' or 'parquet')")
+
+    # 1) Shared engine (credentials come from the environment)
+    engine = _get_engine()
 
     # 2) Compute cutoff date based on months_back
     cutoff_dt = datetime.now(timezone.utc) - timedelta(days=30 * months_back)
     cutoff_str = cutoff_dt.date().isoformat()
 
-    # 3) Create database engine
-    engine = create_engine(
-        f"postgresql+psycopg2://{PG_USER}:{PG_PASSWORD}@{PG_HOST}/{PG_DB}",
-        connect_args={"options": "-c statement_timeout=0"}
-    )
-
-    # 4) Define the SQL query with dynamic cutoff filter
-    QUERY = dedent(f"""
+    # 3) Define the SQL queries with dynamic cutoff filter.  The revenue
+    # summary doesn't depend on the vendor CTEs, so it is a query of its own
+    # that runs on a second connection alongside them and is joined back on
+    # (Partner ID, Month) in pandas.
+    Q_REQSUM = dedent(f"""
     WITH
 -- 1) Invoice‐ and EPR‐level revenue summary
 RequestSummary AS (
@@ -120,9 +240,20 @@ RequestSummary AS (
   JOIN tenant."Organization"                   buyerorg
     ON buyerorg."id" = p2."buyerOrgId"
   WHERE epri."eprInvoiceStatusId" IN (0,1,2)
+    -- only the months VendorData keeps can ever be joined
+    AND epr."activatedOn" >= DATE_TRUNC('month', '{cutoff_str}'::date)
   GROUP BY 1,2
-),
+)
+SELECT
+  rs."Partner ID",
+  rs."Month",
+  ROUND((rs."Platform Fee"/100000)::numeric,2)      AS "Platform Fee (in lacs)",
+  ROUND((rs."Buyer Revenue Share"/100000)::numeric,2) AS "Buyer Revenue Share (in lacs)"
+FROM RequestSummary rs;
+    """)
 
+    Q_VENDOR = dedent(f"""
+    WITH
 -- 2) Monthly vendor×buyer summary
 -- 2) Monthly vendor×buyer summary (from start to today)
 VendorData AS (
@@ -376,6 +507,7 @@ VendorCategories AS (
 -- 6) Final output
 SELECT
   m."Month",
+  m."Partner ID",
   vendororg."PAN"                                   AS "PAN",
   vendororg."legalName"                             AS "Supplier Name",
   buyerorg."legalName"                              AS "Buyer Name",
@@ -387,8 +519,6 @@ SELECT
   ROUND(m."Days Advanced"::numeric,2)               AS "Days Advanced",
   ROUND((m."Effective Discount"/100000)::numeric,2) AS "Effective Discount (in lacs)",
   ROUND(m."Acc Rate"::numeric,2)                    AS "Acc Rate",
-  ROUND((rs."Platform Fee"/100000)::numeric,2)      AS "Platform Fee (in lacs)",
-  ROUND((rs."Buyer Revenue Share"/100000)::numeric,2) AS "Buyer Revenue Share (in lacs)",
   vendororg."relationshipManagerName"                AS "RM Name",
   ROUND(m."APR"::numeric,2)                         AS "APR",
   vc.first_tofu_month                               AS "First TOFU Month",
@@ -398,11 +528,17 @@ SELECT
   vc.tofu_cat_6m                                    AS "TOFU Category (6m)",
   vc.tofu_cat_12m                                   AS "TOFU Category (12m)",
   vc.bofu_cat_6m                                    AS "BOFU Category (6m)",
-  vc.bofu_cat_12m                                   AS "BOFU Category (12m)"
+  vc.bofu_cat_12m                                   AS "BOFU Category (12m)",
+  -- weighted fields: TOFU (in lacs) × the rounded column, as above
+  ROUND((m."TOFU"/100000)::numeric,2)
+    * ROUND(m."Credit Period"::numeric,2)           AS "Wtd Credit Period-Calculated",
+  ROUND((m."TOFU"/100000)::numeric,2)
+    * ROUND(m."Max Days Advanced"::numeric,2)       AS "Wtd Max Days-Calculated",
+  ROUND((m."TOFU"/100000)::numeric,2)
+    * ROUND(m."Days Advanced"::numeric,2)           AS "Wtd Act Days-Calculated",
+  ROUND((m."TOFU"/100000)::numeric,2)
+    * ROUND(m."APR"::numeric,2)                     AS "Wtd APR"
 FROM VendorData m
-LEFT JOIN RequestSummary rs
-  ON rs."Partner ID" = m."Partner ID"
- AND rs."Month"      = m."Month"
 JOIN tenant."Partner"         p         ON p."id"             = m."Partner ID"
 JOIN tenant."Organization"    vendororg  ON vendororg."id"     = p."vendorOrgId"
 JOIN tenant."Organization"    buyerorg   ON buyerorg."id"      = p."buyerOrgId"
@@ -413,35 +549,34 @@ LIMIT 100000;
 
     """)
 
-    # 5) Execute query
-    print("Running monthly metrics query …")
-    df = pd.read_sql_query(QUERY, engine)
-
-    # 1) coerce to datetime (this will be tz‐aware because your SQL has UTC timestamps)
-    df['Month'] = pd.to_datetime(df['Month'], utc=True)
-
-    # 2) strip the timezone off so that dtype is datetime64[ns] (no tz)
-    df['Month'] = df['Month'].dt.tz_localize(None)
-
-    # 3) now cutoff_dt is naive, so this comparison works:
+    # 4) Execute both queries side by side, each on its own pooled connection
+    key = hashlib.blake2b((Q_VENDOR + Q_REQSUM).encode(), digest_size=8).hexdigest()
+    cache_path = os.path.join(out_dir, ".cache", f"{key}.parquet")
+    df = _read_query_cache(cache_path, cache_ttl)
+    if df is None:
+        print("Running monthly metrics query …")
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            vendor = pool.submit(_read_query, Q_VENDOR, engine)
+            reqsum = pool.submit(_read_query, Q_REQSUM, engine)
+            df = _join_request_summary(vendor.result(), reqsum.result())
+        _write_query_cache(cache_path, df)
+
+    # 5) Strip timezones for Excel in one pass: Month is coerced through UTC
+    # (it can arrive as object if the offsets differ), every other tz-aware
+    # column (numpy or Arrow timestamp) is converted to naive UTC alongside it
+    tz_cols = ["Month", *(c for c, t in df.dtypes.items()
+                          if c != "Month" and getattr(getattr(t, "pyarrow_dtype", t), "tz", None))]
+    df = df.assign(**{c: pd.to_datetime(df[c], utc=True).dt.tz_localize(None) for c in tz_cols})
+
+    # now cutoff_dt is naive, so this comparison works:
     # df = df[df['Month'] >= cutoff_dt]  
 
-    # 7) Calculate weighted fields
-    df['Wtd Credit Period-Calculated'] = df['TOFU (in lacs)'] * df['Credit Period']
-    df['Wtd Max Days-Calculated']     = df['TOFU (in lacs)'] * df['Max Days Advanced']
-    df['Wtd Act Days-Calculated']     = df['TOFU (in lacs)'] * df['Days Advanced']
-    df['Wtd APR']                     = df['TOFU (in lacs)'] * df['APR']
-    df['Wtd Buyer Rev Share']         = df['TOFU (in lacs)'] * df['Buyer Revenue Share (in lacs)']
-
-    # 8) Drop timezone info for Excel compatibility
-    for col in df.select_dtypes(include=["datetimetz"]).columns:
-        df[col] = df[col].dt.tz_convert(None)
-
-    # 9) Write to Excel
+    # 6) Write to Excel (or Parquet)
     os.makedirs(out_dir, exist_ok=True)
-    out_path = os.path.join(out_dir, f"cashflo_metrics_{months_back}m.xlsx")
-    df.to_excel(out_path, index=False)
+    out_path = os.path.join(out_dir, f"cashflo_metrics_{months_back}m.{out_format}")
+    if out_format == "parquet":
+        df.to_parquet(out_path, engine="pyarrow", compression="zstd", index=False)
+    else:
+        write_xlsx(df, out_path)
 
-    # 10) Clean up
-    engine.dispose()
     return out_path
@@ -1,53 +1,69 @@
+import hashlib
 import os
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from sqlalchemy import create_engine
+from dateutil.relativedelta import relativedelta
+from sqlalchemy import text
 from textwrap import dedent
 from dotenv import load_dotenv
 
+from pipeline.data_pull import _get_engine, _read_query_cache, _write_query_cache
+from pipeline.excel import write_xlsx
+
 # Load environment variables from .env
 load_dotenv()
 
-def run(
-    months_back: int   = 6,
-    out_dir:    str    = "Output",
-    **kwargs,
-) -> str:
-    """Return the path to the freshly-written Excel file."""
-    # 1) Load database credentials from environment
-    PG_USER = os.getenv("PG_USER")
-    PG_PASSWORD = os.getenv("PG_PASSWORD")
-    PG_HOST = os.getenv("PG_HOST")
-    PG_DB = os.getenv("PG_DB")
-
-    if not all([PG_USER, PG_PASSWORD, PG_HOST, PG_DB]):
-        raise EnvironmentError("One or more PostgreSQL credentials are missing in the environment.")
-
-    # 2) Compute cutoff date based on months_back
-    today = datetime.now(timezone.utc)
-    window_end = datetime(today.year, today.month, 1, tzinfo=timezone.utc)
-    window_start = window_end - timedelta(days=30 * months_back)
-
-    # Convert to string format for SQL injection
-    window_start_str = window_start.date().isoformat()
-    window_end_str = window_end.date().isoformat()
-    # 3) Create database engine
-    engine = create_engine(
-        f"postgresql+psycopg2://{PG_USER}:{PG_PASSWORD}@{PG_HOST}/{PG_DB}",
-        connect_args={"options": "-c statement_timeout=0"}
-    )
-
-    # 4) Define the SQL query with dynamic cutoff filter
-    QUERY = dedent(f"""
+# The vendor summary query.  The window bounds are bind parameters, so this
+# is built (and compiled by SQLAlchemy) once per process, not once per run.
+QUERY = text(dedent("""
  -- Final vendor‐level summary across 6M and 12M windows, listing buyers and all KPIs
 WITH
 
 -- 1) Invoice‐ and EPR‐level revenue summary
-DateParams AS (
-  SELECT 
-    DATE '{window_start_str}' AS window_start,
-    DATE '{window_end_str}'   AS window_end,
-    DATE_TRUNC('month', DATE '{window_end_str}') AS window_end_month
+-- buyer id → revenue-share formula (see the CASE in RequestSummary) and
+-- its APR floor / share; buyers not listed earn no revenue share
+BuyerRevenueRule (buyer_id, formula, apr_offset, multiplier) AS (
+  VALUES
+    (128999, 1,    8::numeric,   NULL::numeric),
+    ( 11111, 1,    8::numeric,   NULL::numeric),
+    ( 24814, 1,    8::numeric,   NULL::numeric),
+    (163022, 1,    8::numeric,   NULL::numeric),
+    (   448, 3, NULL::numeric, 0.0875::numeric),
+    (  9916, 3, NULL::numeric, 0.0875::numeric),
+    (158109, 3, NULL::numeric, 0.0875::numeric),
+    (   586, 3, NULL::numeric,  0.095::numeric),
+    ( 10963, 3, NULL::numeric,   0.10::numeric),
+    ( 11326, 3, NULL::numeric,   0.10::numeric),
+    (    11, 3, NULL::numeric,   0.10::numeric),
+    (246800, 3, NULL::numeric,   0.10::numeric),
+    (275674, 3, NULL::numeric,   0.10::numeric),
+    ( 24217, 3, NULL::numeric,   0.15::numeric),
+    (136067, 3, NULL::numeric,   0.15::numeric),
+    (  4752, 3, NULL::numeric,   0.15::numeric),
+    (154673, 3, NULL::numeric,   0.15::numeric),
+    (   379, 4, NULL::numeric,   0.35::numeric),
+    ( 22483, 3, NULL::numeric,   0.14::numeric),
+    (199095, 3, NULL::numeric,   0.14::numeric),
+    (   368, 3, NULL::numeric,   0.13::numeric),
+    (193694, 3, NULL::numeric,   0.18::numeric),
+    (    66, 2,    7::numeric,   0.20::numeric),
+    (   452, 2,    7::numeric,   0.20::numeric),
+    (   546, 2,    7::numeric,   0.20::numeric),
+    (   431, 2,    7::numeric,   0.20::numeric),
+    ( 11323, 2,  6.5::numeric,   0.16::numeric),
+    (  8672, 2,    8::numeric,   0.10::numeric),
+    (  1437, 2,  6.5::numeric,   0.20::numeric),
+    (   153, 2,    9::numeric,   0.35::numeric),
+    (    55, 2, 7.34::numeric,   0.11::numeric),
+    (  8933, 2,  8.5::numeric,   0.20::numeric),
+    (196860, 2,    8::numeric,   0.50::numeric),
+    (196029, 2,    8::numeric,   0.50::numeric),
+    (    38, 2,   10::numeric,   0.15::numeric),
+    (  2795, 5, NULL::numeric,   NULL::numeric),
+    ( 11625, 6, NULL::numeric,   NULL::numeric),
+    ( 24505, 7, NULL::numeric,   NULL::numeric),
+    (   688, 8, NULL::numeric,   NULL::numeric)
 ),
 RequestSummary AS (
   SELECT
@@ -56,63 +72,41 @@ RequestSummary AS (
     SUM(DISTINCT epr."platformFee")               AS "Platform Fee",
     SUM(
       GREATEST(
-        CASE
-          WHEN buyerorg."id" IN (128999,11111,24814,163022) THEN
-            ((epri."apr"-8)*inv."amount"*epri."daysAdvanced")/36500
+        CASE r.formula
+          -- tiered spread over an APR floor
+          WHEN 1 THEN
+            ((epri."apr"-r.apr_offset)*inv."amount"*epri."daysAdvanced")/36500
             * CASE
                 WHEN inv."amount" < 150000000 THEN 0.125
                 WHEN inv."amount" BETWEEN 150000000 AND 250000000 THEN 0.15
                 ELSE 0.175
               END
-          WHEN buyerorg."id" IN (448,9916,158109) THEN epri."effectiveDiscount"*0.0875
-          WHEN buyerorg."id" = 586            THEN epri."effectiveDiscount"*0.095
-          WHEN buyerorg."id" IN (10963,11326,11,246800,275674)
-                                               THEN epri."effectiveDiscount"*0.10
-          WHEN buyerorg."id" IN (24217,136067,4752,154673)
-                                               THEN epri."effectiveDiscount"*0.15
-          WHEN buyerorg."id" = 379
-                                               THEN (epri."effectiveDiscountRate"*inv."amount"/100)*0.35
-          WHEN buyerorg."id" IN (22483,199095)
-                                               THEN epri."effectiveDiscount"*0.14
-          WHEN buyerorg."id" = 368            THEN epri."effectiveDiscount"*0.13
-          WHEN buyerorg."id" = 193694         THEN epri."effectiveDiscount"*0.18
-          WHEN buyerorg."id" IN (66,452,546,431)
-            THEN (((epri."apr"-7)*inv."amount"*epri."daysAdvanced")/36500)*0.20
-          WHEN buyerorg."id" = 11323
-            THEN (((epri."apr"-6.5)*inv."amount"*epri."daysAdvanced")/36500)*0.16
-          WHEN buyerorg."id" = 8672
-            THEN (((epri."apr"-8)*inv."amount"*epri."daysAdvanced")/36500)*0.10
-          WHEN buyerorg."id" = 1437
-            THEN (((epri."apr"-6.5)*inv."amount"*epri."daysAdvanced")/36500)*0.20
-          WHEN buyerorg."id" = 153
-            THEN (((epri."apr"-9)*inv."amount"*epri."daysAdvanced")/36500)*0.35
-          WHEN buyerorg."id" = 55
-            THEN (((epri."apr"-7.34)*inv."amount"*epri."daysAdvanced")/36500)*0.11
-          WHEN buyerorg."id" = 8933
-            THEN (((epri."apr"-8.5)*inv."amount"*epri."daysAdvanced")/36500)*0.20
-          WHEN buyerorg."id" IN (196860,196029)
-            THEN (((epri."apr"-8)*inv."amount"*epri."daysAdvanced")/36500)*0.50
-          WHEN buyerorg."id" = 38
-            THEN (((epri."apr"-10)*inv."amount"*epri."daysAdvanced")/36500)*0.15
-          WHEN buyerorg."id" = 2795
-            THEN epri."effectiveDiscount"
+          -- flat share of the spread over an APR floor
+          WHEN 2 THEN (((epri."apr"-r.apr_offset)*inv."amount"*epri."daysAdvanced")/36500)*r.multiplier
+          -- flat share of the effective discount
+          WHEN 3 THEN epri."effectiveDiscount"*r.multiplier
+          -- flat share of the discount at the effective rate
+          WHEN 4 THEN (epri."effectiveDiscountRate"*inv."amount"/100)*r.multiplier
+          -- one-off buyer agreements
+          WHEN 5 THEN
+            epri."effectiveDiscount"
                  * (
                      EXTRACT(DAY FROM inv."estimatedDueDateAtUtc" - inv."dueDateAtUtc")::float
                      / EXTRACT(DAY FROM inv."estimatedDueDateAtUtc" - epri."toBeClearedOnUtc")::float
                    ) * 0.25
-          WHEN buyerorg."id" = 11625 THEN
+          WHEN 6 THEN
             CASE
               WHEN (epri."apr" - epri."apr"*0.14) > 10
                 THEN epri."effectiveDiscount"*0.14
               ELSE ((epri."apr"-10)*inv."amount"*epri."daysAdvanced")/36500
             END
-          WHEN buyerorg."id" = 24505 THEN
+          WHEN 7 THEN
             CASE
               WHEN epri."apr"/1.15 < 10.25
                 THEN epri."effectiveDiscount"*(epri."apr"-10.25)/100
               ELSE epri."effectiveDiscount"*0.15
             END
-          WHEN buyerorg."id" = 688 THEN
+          WHEN 8 THEN
             CASE
               WHEN epri."apr" < 15
                 THEN epri."effectiveDiscount"*0.12
@@ -131,17 +125,20 @@ RequestSummary AS (
     ON p2."id" = epr."partnerId"
   JOIN tenant."Organization"                   buyerorg
     ON buyerorg."id" = p2."buyerOrgId"
+  LEFT JOIN BuyerRevenueRule                   r
+    ON r.buyer_id = buyerorg."id"
   WHERE epri."eprInvoiceStatusId" IN (0,1,2)
+    AND epr."activatedOn" >= DATE_TRUNC('month', CAST(:window_start AS date))
   GROUP BY 1, 2
 ),
 
--- 2) Partner×month metrics (all history)
+-- 2) Partner×month metrics (from the window start on)
 VendorData AS (
   SELECT
     DATE_TRUNC('month', COALESCE(i."createdAt", epriAgg."activatedOn")) AS "Month",
     p."id"                                        AS "Partner ID",
     SUM(i."amount")                               AS "TOFU",
-    MAX(epriAgg."requestPlacedAmount")            AS "BOFU",
+    epriAgg."requestPlacedAmount"                 AS "BOFU",
     -- Credit Period
     SUM(
       CAST(
@@ -161,14 +158,14 @@ VendorData AS (
         - p."settlementDays"
       ) * i."amount"
     ) / NULLIF(SUM(i."amount"), 0)                 AS "Max Days Advanced",
-    MAX(epriAgg."weightedDaysAdvanced")           AS "Days Advanced",
-    MAX(epriAgg."totalEffectiveDiscount")         AS "Effective Discount",
+    epriAgg."weightedDaysAdvanced"                AS "Days Advanced",
+    epriAgg."totalEffectiveDiscount"              AS "Effective Discount",
     -- Acceleration Rate
-    (COALESCE(MAX(epriAgg."requestPlacedAmount"),0) / NULLIF(SUM(i."amount"),0)) * 100
+    (COALESCE(epriAgg."requestPlacedAmount",0) / NULLIF(SUM(i."amount"),0)) * 100
                                                   AS "Acc Rate",
     -- APR
-    ((MAX(epriAgg."totalEffectiveDiscount") / NULLIF(MAX(epriAgg."requestPlacedAmount"),0))
-      * (365 / NULLIF(MAX(epriAgg."weightedDaysAdvanced"),0))
+    ((epriAgg."totalEffectiveDiscount" / NULLIF(epriAgg."requestPlacedAmount",0))
+      * (365 / NULLIF(epriAgg."weightedDaysAdvanced",0))
     ) * 100                                       AS "APR"
   FROM (
     SELECT DISTINCT ON (
@@ -184,6 +181,8 @@ VendorData AS (
     WHERE i1."amount" > 0
       AND DATE_TRUNC('day', i1."dueDateAtUtc") > DATE_TRUNC('day', i1."createdAt") + INTERVAL '1 day'
       AND DATE_TRUNC('day', i1."createdAt") < DATE_TRUNC('day', i1."generatedAtUtc") + INTERVAL '180 day'
+      -- only months from window_start on are ever read (see VendorStats)
+      AND i1."generatedAtUtc" >= CAST(:history_start AS date)
     ORDER BY
       trim(i1."invoiceNumber"),
       i1."partnerId",
@@ -208,13 +207,17 @@ VendorData AS (
     JOIN discounting."Invoice"                  i2
       ON i2."id" = epri2."invoiceId"
     WHERE epri2."eprInvoiceStatusId" IN (0,1,2)
+      AND epr."activatedOn" >= DATE_TRUNC('month', CAST(:window_start AS date))
     GROUP BY 1, 2
   ) epriAgg
     ON i."partnerId" = epriAgg."partnerId"
    AND DATE_TRUNC('month', COALESCE(i."createdAt", epriAgg."activatedOn")) = epriAgg."activatedOn"
   JOIN tenant."Partner" p
     ON p."id" = COALESCE(i."partnerId", epriAgg."partnerId")
-  GROUP BY 1, 2
+  -- epriAgg is unique per (partner, month), so its columns are constant
+  -- within each group: grouping on them replaces the MAX() wrappers
+  GROUP BY 1, 2,
+    epriAgg."requestPlacedAmount", epriAgg."weightedDaysAdvanced", epriAgg."totalEffectiveDiscount"
 ),
 
 -- 3) Roll up to vendor×month, include all needed fields
@@ -245,39 +248,23 @@ VendorMonthly AS (
 VendorStats AS (
   SELECT
     vm.*,
-    dp.window_start,
-    dp.window_end,
 
     -- 6M Aggregates (within window)
-    COALESCE(SUM(CASE WHEN vm."Month" BETWEEN dp.window_start AND dp.window_end THEN vm."TOFU" END) OVER w6, 0) AS sum_tofu_amt_6,
-    COALESCE(SUM(CASE WHEN vm."Month" BETWEEN dp.window_start AND dp.window_end THEN vm."BOFU" END) OVER w6, 0) AS sum_bofu_amt_6,
+    COALESCE(SUM(CASE WHEN vm."Month" BETWEEN CAST(:window_start AS date) AND CAST(:window_end AS date) THEN vm."TOFU" END) OVER w6, 0) AS sum_tofu_amt_6,
+    COALESCE(SUM(CASE WHEN vm."Month" BETWEEN CAST(:window_start AS date) AND CAST(:window_end AS date) THEN vm."BOFU" END) OVER w6, 0) AS sum_bofu_amt_6,
 
-    COALESCE(SUM(CASE WHEN vm."Month" BETWEEN dp.window_start AND dp.window_end AND vm."TOFU">0 THEN 1 ELSE 0 END) OVER w6, 0) AS count_tofu_6,
-    COALESCE(SUM(CASE WHEN vm."Month" BETWEEN dp.window_start AND dp.window_end AND vm."BOFU">0 THEN 1 ELSE 0 END) OVER w6, 0) AS count_bofu_6,
+    COALESCE(SUM(CASE WHEN vm."Month" BETWEEN CAST(:window_start AS date) AND CAST(:window_end AS date) AND vm."TOFU">0 THEN 1 ELSE 0 END) OVER w6, 0) AS count_tofu_6,
+    COALESCE(SUM(CASE WHEN vm."Month" BETWEEN CAST(:window_start AS date) AND CAST(:window_end AS date) AND vm."BOFU">0 THEN 1 ELSE 0 END) OVER w6, 0) AS count_bofu_6,
 
     -- 12M Aggregates (within window)
-    COALESCE(SUM(CASE WHEN vm."Month" BETWEEN dp.window_start AND dp.window_end THEN vm."TOFU" END) OVER w12, 0) AS sum_tofu_amt_12,
-    COALESCE(SUM(CASE WHEN vm."Month" BETWEEN dp.window_start AND dp.window_end THEN vm."BOFU" END) OVER w12, 0) AS sum_bofu_amt_12,
-
-    COALESCE(SUM(CASE WHEN vm."Month" BETWEEN dp.window_start AND dp.window_end AND vm."TOFU">0 THEN 1 ELSE 0 END) OVER w12, 0) AS count_tofu_12,
-    COALESCE(SUM(CASE WHEN vm."Month" BETWEEN dp.window_start AND dp.window_end AND vm."BOFU">0 THEN 1 ELSE 0 END) OVER w12, 0) AS count_bofu_12,
-
-    -- BOFU before current month but only within window
-    COALESCE(
-      MAX(CASE
-             WHEN vm."BOFU">0 AND vm."Month" BETWEEN dp.window_start AND dp.window_end
-             THEN vm."Month"
-           END) OVER (
-             PARTITION BY vm."Vendor ID"
-             ORDER BY vm."Month"
-             ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
-           ),
-      DATE '1900-01-01'
-    ) AS last_bofu_before
+    COALESCE(SUM(CASE WHEN vm."Month" BETWEEN CAST(:window_start AS date) AND CAST(:window_end AS date) THEN vm."TOFU" END) OVER w12, 0) AS sum_tofu_amt_12,
+    COALESCE(SUM(CASE WHEN vm."Month" BETWEEN CAST(:window_start AS date) AND CAST(:window_end AS date) THEN vm."BOFU" END) OVER w12, 0) AS sum_bofu_amt_12,
+
+    COALESCE(SUM(CASE WHEN vm."Month" BETWEEN CAST(:window_start AS date) AND CAST(:window_end AS date) AND vm."TOFU">0 THEN 1 ELSE 0 END) OVER w12, 0) AS count_tofu_12,
+    COALESCE(SUM(CASE WHEN vm."Month" BETWEEN CAST(:window_start AS date) AND CAST(:window_end AS date) AND vm."BOFU">0 THEN 1 ELSE 0 END) OVER w12, 0) AS count_bofu_12
 
   FROM VendorMonthly vm
-  CROSS JOIN DateParams dp
-  WHERE vm."Month" BETWEEN dp.window_start AND dp.window_end
+  WHERE vm."Month" BETWEEN CAST(:window_start AS date) AND CAST(:window_end AS date)
 
   WINDOW
     w6  AS (PARTITION BY vm."Vendor ID" ORDER BY vm."Month"
@@ -290,34 +277,31 @@ VendorCategories AS (
   SELECT
     vs."Vendor ID",
     vs."Month",
-    dp.window_start,
-    dp.window_end,
-    dp.window_end_month,
 
 MIN(CASE
-      WHEN vs."TOFU" > 0 AND vs."Month" BETWEEN dp.window_start AND dp.window_end
+      WHEN vs."TOFU" > 0 AND vs."Month" BETWEEN CAST(:window_start AS date) AND CAST(:window_end AS date)
       THEN vs."Month"
     END) OVER w_v AS first_tofu_month,
 
 MAX(CASE
-      WHEN vs."TOFU" > 0 AND vs."Month" BETWEEN dp.window_start AND dp.window_end
+      WHEN vs."TOFU" > 0 AND vs."Month" BETWEEN CAST(:window_start AS date) AND CAST(:window_end AS date)
       THEN vs."Month"
     END) OVER w_v AS last_tofu_month,
 
 MIN(CASE
-      WHEN vs."BOFU" > 0 AND vs."Month" BETWEEN dp.window_start AND dp.window_end
+      WHEN vs."BOFU" > 0 AND vs."Month" BETWEEN CAST(:window_start AS date) AND CAST(:window_end AS date)
       THEN vs."Month"
     END) OVER w_v AS first_bofu_month,
 
 MAX(CASE
-      WHEN vs."BOFU" > 0 AND vs."Month" BETWEEN dp.window_start AND dp.window_end
+      WHEN vs."BOFU" > 0 AND vs."Month" BETWEEN CAST(:window_start AS date) AND CAST(:window_end AS date)
       THEN vs."Month"
     END) OVER w_v AS last_bofu_month,
 
     -- TOFU Category (6M)
     CASE
-      WHEN MIN(CASE WHEN vs."TOFU" > 0 THEN vs."Month" END) OVER w_v = dp.window_end_month
-           AND MIN(CASE WHEN vs."TOFU" > 0 THEN vs."Month" END) OVER w_v >= dp.window_start
+      WHEN MIN(CASE WHEN vs."TOFU" > 0 THEN vs."Month" END) OVER w_v = DATE_TRUNC('month', CAST(:window_end AS date))
+           AND MIN(CASE WHEN vs."TOFU" > 0 THEN vs."Month" END) OVER w_v >= CAST(:window_start AS date)
       THEN 'TOFU New'
       WHEN vs.count_tofu_6 >= 5 THEN 'Regular'
       WHEN vs.count_tofu_6 BETWEEN 3 AND 4 THEN 'Sporadic'
@@ -327,8 +311,8 @@ MAX(CASE
 
     -- BOFU Category (6M)
     CASE
-      WHEN MIN(CASE WHEN vs."BOFU" > 0 THEN vs."Month" END) OVER w_v = dp.window_end_month
-           AND MIN(CASE WHEN vs."BOFU" > 0 THEN vs."Month" END) OVER w_v >= dp.window_start
+      WHEN MIN(CASE WHEN vs."BOFU" > 0 THEN vs."Month" END) OVER w_v = DATE_TRUNC('month', CAST(:window_end AS date))
+           AND MIN(CASE WHEN vs."BOFU" > 0 THEN vs."Month" END) OVER w_v >= CAST(:window_start AS date)
       THEN 'BOFU New'
       WHEN vs.count_bofu_6 = 0 THEN 'Never Transacted'
       WHEN (SUM(CASE WHEN vs."TOFU" > 0 THEN 1 ELSE 0 END) OVER w3_6 = 3
@@ -345,8 +329,8 @@ MAX(CASE
 
     -- TOFU Category (12M)
     CASE
-      WHEN MIN(CASE WHEN vs."TOFU" > 0 THEN vs."Month" END) OVER w_v = dp.window_end_month
-           AND MIN(CASE WHEN vs."TOFU" > 0 THEN vs."Month" END) OVER w_v >= dp.window_start
+      WHEN MIN(CASE WHEN vs."TOFU" > 0 THEN vs."Month" END) OVER w_v = DATE_TRUNC('month', CAST(:window_end AS date))
+           AND MIN(CASE WHEN vs."TOFU" > 0 THEN vs."Month" END) OVER w_v >= CAST(:window_start AS date)
       THEN 'TOFU New'
       WHEN vs.count_tofu_12 >= 10 THEN 'Regular'
       WHEN vs.count_tofu_12 BETWEEN 6 AND 9 THEN 'Sporadic'
@@ -356,8 +340,8 @@ MAX(CASE
 
     -- BOFU Category (12M)
     CASE
-      WHEN MIN(CASE WHEN vs."BOFU" > 0 THEN vs."Month" END) OVER w_v = dp.window_end_month
-           AND MIN(CASE WHEN vs."BOFU" > 0 THEN vs."Month" END) OVER w_v >= dp.window_start
+      WHEN MIN(CASE WHEN vs."BOFU" > 0 THEN vs."Month" END) OVER w_v = DATE_TRUNC('month', CAST(:window_end AS date))
+           AND MIN(CASE WHEN vs."BOFU" > 0 THEN vs."Month" END) OVER w_v >= CAST(:window_start AS date)
       THEN 'BOFU New'
       WHEN vs.count_bofu_12 = 0 THEN 'Never Transacted'
       WHEN vs.sum_bofu_amt_12::numeric / NULLIF(vs.sum_tofu_amt_12, 0) >= 0.8 THEN 'High'
@@ -367,7 +351,6 @@ MAX(CASE
     END AS bofu_cat_12m
 
   FROM VendorStats vs
-  CROSS JOIN DateParams dp
   WINDOW
     w_v AS (PARTITION BY vs."Vendor ID"),
     w3_6 AS (PARTITION BY vs."Vendor ID" ORDER BY vs."Month" ROWS BETWEEN 2 PRECEDING AND CURRENT ROW),
@@ -407,47 +390,23 @@ VendorSummary AS (
     -- weighted averages in lacs (metric * TOFU / sum_tofu_amt_6 / 100000)
     ROUND((
   SUM(vm."ED")
-    FILTER (
-      WHERE vm."Month"
-        BETWEEN date_trunc('month', ls."Month") - INTERVAL '5 months'
-            AND ls."Month"
-    )
+    FILTER (WHERE win.in_6m)
   / 6.0
   / 100000
 )::numeric,2) AS "ED Wtd Avg (6M)",
     ROUND((
   SUM((vm."Platform Fee" + vm."Buyer Revenue Share"))
-    FILTER (
-      WHERE vm."Month"
-        BETWEEN date_trunc('month', ls."Month") - INTERVAL '5 months'
-            AND ls."Month"
-    )
+    FILTER (WHERE win.in_6m)
   / 6.0
   / 100000
 )::numeric,2) AS "Revenue Wtd Avg (6M)",
 
     -- derived KPIs (no lacs division)
     ROUND((ls.sum_bofu_amt_6::numeric / NULLIF(ls.sum_tofu_amt_6,0)*100),2)                AS "Acceleration (6M)",
-    ROUND((SUM(vm."Credit Period"*vm."TOFU")FILTER (
-      WHERE vm."Month"
-        BETWEEN date_trunc('month', ls."Month") - INTERVAL '5 months'
-            AND ls."Month"
-    ) / NULLIF(ls.sum_tofu_amt_6,0))::numeric,2)     AS "Wtd Avg Credit Period (6M)",
-    ROUND((SUM(vm."Max Days Advanced"*vm."TOFU")FILTER (
-      WHERE vm."Month"
-        BETWEEN date_trunc('month', ls."Month") - INTERVAL '5 months'
-            AND ls."Month"
-    ) / NULLIF(ls.sum_tofu_amt_6,0))::numeric,2) AS "Wtd Avg Max Days (6M)",
-    ROUND((SUM(vm."Days Advanced"*vm."TOFU")FILTER (
-      WHERE vm."Month"
-        BETWEEN date_trunc('month', ls."Month") - INTERVAL '5 months'
-            AND ls."Month"
-    ) / NULLIF(ls.sum_tofu_amt_6,0))::numeric,2)     AS "Wtd Avg Actual Days (6M)",
-    ROUND((SUM(vm."APR"*vm."TOFU")FILTER (
-      WHERE vm."Month"
-        BETWEEN date_trunc('month', ls."Month") - INTERVAL '5 months'
-            AND ls."Month"
-    ) / NULLIF(ls.sum_tofu_amt_6,0))::numeric,2)              AS "Wtd Avg APR (6M)",
+    ROUND((SUM(vm."Credit Period"*vm."TOFU")FILTER (WHERE win.in_6m) / NULLIF(ls.sum_tofu_amt_6,0))::numeric,2)     AS "Wtd Avg Credit Period (6M)",
+    ROUND((SUM(vm."Max Days Advanced"*vm."TOFU")FILTER (WHERE win.in_6m) / NULLIF(ls.sum_tofu_amt_6,0))::numeric,2) AS "Wtd Avg Max Days (6M)",
+    ROUND((SUM(vm."Days Advanced"*vm."TOFU")FILTER (WHERE win.in_6m) / NULLIF(ls.sum_tofu_amt_6,0))::numeric,2)     AS "Wtd Avg Actual Days (6M)",
+    ROUND((SUM(vm."APR"*vm."TOFU")FILTER (WHERE win.in_6m) / NULLIF(ls.sum_tofu_amt_6,0))::numeric,2)              AS "Wtd Avg APR (6M)",
 
     -- 12M aggregates in lacs
     ls.count_tofu_12                               AS "TOFU Count (12M)",
@@ -460,18 +419,12 @@ VendorSummary AS (
 
     -- weighted averages 12M in lacs
     ROUND((
-      SUM(vm."ED") FILTER (
-        WHERE vm."Month" BETWEEN date_trunc('month',CURRENT_DATE)-INTERVAL '12 months'
-                              AND date_trunc('month',CURRENT_DATE)-INTERVAL '1 month'
-      )
+      SUM(vm."ED") FILTER (WHERE win.in_12m)
       / 6.0
       /100000
     )::numeric,2)                                    AS "ED Wtd Avg (12M)",
     ROUND((
-      SUM((vm."Platform Fee"+vm."Buyer Revenue Share")) FILTER (
-        WHERE vm."Month" BETWEEN date_trunc('month',CURRENT_DATE)-INTERVAL '12 months'
-                              AND date_trunc('month',CURRENT_DATE)-INTERVAL '1 month'
-      )
+      SUM((vm."Platform Fee"+vm."Buyer Revenue Share")) FILTER (WHERE win.in_12m)
       / 6.0
       /100000
     )::numeric,2)                                    AS "Revenue Wtd Avg (12M)",
@@ -479,22 +432,10 @@ VendorSummary AS (
     -- derived 12M KPIs
     ROUND((ls.sum_bofu_amt_12::numeric / NULLIF(ls.sum_tofu_amt_12,0)*100),2)               AS "Acceleration (12M)",
     
-    ROUND((SUM(vm."Credit Period"*vm."TOFU") FILTER (
-      WHERE vm."Month" BETWEEN date_trunc('month',CURRENT_DATE)-INTERVAL '12 months'
-                            AND date_trunc('month',CURRENT_DATE)-INTERVAL '1 month'
-    ) / NULLIF(ls.sum_tofu_amt_12,0))::numeric,2)                                           AS "Wtd Avg Credit Period (12M)",
-    ROUND((SUM(vm."Max Days Advanced"*vm."TOFU") FILTER (
-      WHERE vm."Month" BETWEEN date_trunc('month',CURRENT_DATE)-INTERVAL '12 months'
-                            AND date_trunc('month',CURRENT_DATE)-INTERVAL '1 month'
-    ) / NULLIF(ls.sum_tofu_amt_12,0))::numeric,2)                                           AS "Wtd Avg Max Days (12M)",
-    ROUND((SUM(vm."Days Advanced"*vm."TOFU") FILTER (
-      WHERE vm."Month" BETWEEN date_trunc('month',CURRENT_DATE)-INTERVAL '12 months'
-                            AND date_trunc('month',CURRENT_DATE)-INTERVAL '1 month'
-    ) / NULLIF(ls.sum_tofu_amt_12,0))::numeric,2)                                           AS "Wtd Avg Actual Days (12M)",
-    ROUND((SUM(vm."APR"*vm."TOFU") FILTER (
-      WHERE vm."Month" BETWEEN date_trunc('month',CURRENT_DATE)-INTERVAL '12 months'
-                            AND date_trunc('month',CURRENT_DATE)-INTERVAL '1 month'
-    ) / NULLIF(ls.sum_tofu_amt_12,0))::numeric,2)                                           AS "Wtd Avg APR (12M)",
+    ROUND((SUM(vm."Credit Period"*vm."TOFU") FILTER (WHERE win.in_12m) / NULLIF(ls.sum_tofu_amt_12,0))::numeric,2) AS "Wtd Avg Credit Period (12M)",
+    ROUND((SUM(vm."Max Days Advanced"*vm."TOFU") FILTER (WHERE win.in_12m) / NULLIF(ls.sum_tofu_amt_12,0))::numeric,2) AS "Wtd Avg Max Days (12M)",
+    ROUND((SUM(vm."Days Advanced"*vm."TOFU") FILTER (WHERE win.in_12m) / NULLIF(ls.sum_tofu_amt_12,0))::numeric,2) AS "Wtd Avg Actual Days (12M)",
+    ROUND((SUM(vm."APR"*vm."TOFU") FILTER (WHERE win.in_12m) / NULLIF(ls.sum_tofu_amt_12,0))::numeric,2) AS "Wtd Avg APR (12M)",
 
     -- TOFU/BOFU markers & categories (unchanged)
     vc.first_tofu_month             AS "First TOFU Month",
@@ -516,9 +457,17 @@ VendorSummary AS (
     ON vendororg."id" = vm."Vendor ID"
   LEFT JOIN tenant."Organization" buyerorg
     ON buyerorg."id"  = vm."Buyer ID"
-  CROSS JOIN DateParams dp
+  -- each row's 6M / 12M window membership, evaluated once and shared by
+  -- every FILTERed aggregate above
+  CROSS JOIN LATERAL (
+    SELECT
+      vm."Month" BETWEEN date_trunc('month', ls."Month") - INTERVAL '5 months'
+                     AND ls."Month"                                     AS in_6m,
+      vm."Month" BETWEEN date_trunc('month',CURRENT_DATE)-INTERVAL '12 months'
+                     AND date_trunc('month',CURRENT_DATE)-INTERVAL '1 month' AS in_12m
+  ) win
   -- NEW:
-	WHERE vm."Month" BETWEEN dp.window_start AND dp.window_end
+	WHERE vm."Month" BETWEEN CAST(:window_start AS date) AND CAST(:window_end AS date)
 
 
   GROUP BY
@@ -538,11 +487,67 @@ FROM VendorSummary
 ORDER BY "PAN";
 
 
-    """)
+"""))
+
+
+def run(
+    months_back: int   = 6,
+    out_dir:    str    = "Output",
+    out_format: str    = "xlsx",
+    cache_ttl:  float  = 900,
+    **kwargs,
+) -> str:
+    """
+    Return the path to the freshly-written Excel file (what the dashboard
+    reads) by default, a zstd Parquet file with ``out_format="parquet"``,
+    or both side by side with ``out_format="both"`` (the xlsx path is
+    returned).
+
+    The vendor summary is kept under ``<out_dir>/.cache`` keyed by a hash of
+    the SQL and its window dates; runs within *cache_ttl* seconds of it
+    reuse that instead of re-aggregating the invoice history.
+    ``cache_ttl=0`` always queries.
+    """
+    if out_format not in ("xlsx", "parquet", "both"):
+        raise ValueError(f"Unsupported out_format: {out_format!r} (use 'xlsx', 'parquet' or 'both')")
+
+    # 1) Shared engine (credentials come from the environment)
+    engine = _get_engine()
 
-    # 5) Execute query
-    print("Running monthly metrics query …")
-    df = pd.read_sql_query(QUERY, engine)
+    # 2) Compute cutoff date based on months_back
+    today = datetime.now(timezone.utc)
+    window_end = datetime(today.year, today.month, 1, tzinfo=timezone.utc)
+    # months_back calendar months ending with (and including) window_end's
+    window_start = window_end - relativedelta(months=months_back - 1)
+
+    # Invoices are de-duplicated per financial year of generatedAtUtc and
+    # are created at most ~180 days after it, so every invoice that can land
+    # in the window belongs to a FY starting on/after this date; scanning
+    # from there keeps each de-dup group whole
+    reach = window_start - timedelta(days=190)
+    history_start = datetime(reach.year if reach.month >= 4 else reach.year - 1, 4, 1)
+
+    # Bound as query parameters, so the SQL text is the same on every run
+    params = {
+        "window_start":  window_start.date(),
+        "window_end":    window_end.date(),
+        "history_start": history_start.date(),
+    }
+
+    # 3) Execute query (or reuse the cached result of the same query and window)
+    key = hashlib.blake2b(f"{QUERY.text}{sorted(params.items())}".encode(), digest_size=8).hexdigest()
+    cache_path = os.path.join(out_dir, ".cache", f"{key}.parquet")
+    df = _read_query_cache(cache_path, cache_ttl)
+    if df is None:
+        # stream_results makes psycopg2 use a server-side cursor, so rows
+        # arrive in batches instead of one client-side buffer
+        print("Running monthly metrics query …")
+        chunks = pd.read_sql_query(
+            QUERY, engine.execution_options(stream_results=True),
+            params=params, chunksize=50_000,
+        )
+        df = pd.concat(chunks, ignore_index=True)
+        _write_query_cache(cache_path, df)
 
     # # 1) coerce to datetime (this will be tz‐aware because your SQL has UTC timestamps)
     # df['Month'] = pd.to_datetime(df['Month'], utc=True)
@@ -560,15 +565,29 @@ ORDER BY "PAN";
     # df['Wtd APR']                     = df['TOFU (in lacs)'] * df['APR']
     # df['Wtd Buyer Rev Share']         = df['TOFU (in lacs)'] * df['Buyer Revenue Share (in lacs)']
 
-    # 8) Drop timezone info for Excel compatibility
-    for col in df.select_dtypes(include=["datetimetz"]).columns:
-        df[col] = df[col].dt.tz_convert(None)
+    # 8) Drop timezone info for Excel compatibility (one assign for all columns)
+    tz_cols = df.select_dtypes(include=["datetimetz"]).columns
+    df = df.assign(**{c: df[c].dt.tz_convert(None) for c in tz_cols})
 
-    # 9) Write to Excel
+    # 9) Write to Excel (streamed, constant memory) and/or Parquet
     os.makedirs(out_dir, exist_ok=True)
     out_path = os.path.join(out_dir, f"cashflo_metrics_{months_back}m.xlsx")
-    df.to_excel(out_path, index=False)
+    parquet_path = out_path.replace(".xlsx", ".parquet")
+    if out_format == "xlsx":
+        write_xlsx(df, out_path)
+    elif out_format == "parquet":
+        df.to_parquet(parquet_path, engine="pyarrow", compression="zstd", index=False)
+        return parquet_path
+    else:
+        # pyarrow encodes and compresses without the GIL, so the Parquet
+        # copy is written on a worker thread while the workbook streams out
+        # here; both are on disk before we return
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            parquet = pool.submit(
+                df.to_parquet, parquet_path,
+                engine="pyarrow", compression="zstd", index=False,
+            )
+            write_xlsx(df, out_path)
+            parquet.result()
 
-    # 10) Clean up
-    engine.dispose()
     return out_path
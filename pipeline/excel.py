@@ -0,0 +1,59 @@
+# pipeline/excel.py
+"""
+The one xlsxwriter writer every workbook export goes through, so they all
+share the same options: constant-memory streaming, a readable date format,
+strings written as text (a supplier name starting with "=" or "http"
+stays a string, never a formula or hyperlink), and inf / NaN written as
+Excel error cells (a ratio over a zero denominator is inf) instead of
+raising.
+"""
+from __future__ import annotations
+
+import pandas as pd
+
+
+def new_workbook(target, nan_inf_to_errors: bool = True):
+    """
+    An xlsxwriter Workbook on *target* (a filename or binary file object)
+    in constant-memory mode: each row is flushed to disk as soon as the next
+    one starts, so rows must be written in order (see write_sheet).
+    """
+    import xlsxwriter
+
+    return xlsxwriter.Workbook(target, {
+        "constant_memory": True,
+        "strings_to_formulas": False,
+        "strings_to_urls": False,
+        "nan_inf_to_errors": nan_inf_to_errors,
+        "default_date_format": "yyyy-mm-dd hh:mm:ss",
+    })
+
+
+def write_sheet(wb, name: str, df: pd.DataFrame, header_fmt=None):
+    """
+    Stream *df* (header + raw value tuples) into a new worksheet *name*,
+    row by row; pandas' to_excel writes column by column, which
+    constant_memory can't take.  Returns the worksheet.
+    """
+    ws = wb.add_worksheet(name)
+    ws.write_row(0, 0, [str(c) for c in df.columns], header_fmt)
+    values = df.astype(object).where(df.notna(), None)   # None → blank cell
+    for r, row in enumerate(values.itertuples(index=False, name=None), start=1):
+        ws.write_row(r, 0, row)
+    return ws
+
+
+def write_xlsx(
+    df: pd.DataFrame,
+    target,
+    sheet_name: str = "Sheet1",
+    header_fmt: dict | None = None,
+    nan_inf_to_errors: bool = True,
+) -> None:
+    """
+    Write *df* as the single sheet of a new workbook at *target*;
+    *header_fmt* is an xlsxwriter format dict for the header row.
+    """
+    wb = new_workbook(target, nan_inf_to_errors=nan_inf_to_errors)
+    write_sheet(wb, sheet_name, df, wb.add_format(header_fmt) if header_fmt else None)
+    wb.close()
@@ -0,0 +1,25 @@
+# pipeline/fiscal.py
+"""Indian fiscal-year (Apr-Mar) labels shared by the quarterly builders."""
+import numpy as np
+import pandas as pd
+
+# Indian FY by month index (Jan = 0): Jan-Mar are Q4 of the FY that started
+# the previous April, Apr-Dec belong to the FY ending next March
+_Q_LUT = np.array(["Q4", "Q4", "Q4", "Q1", "Q1", "Q1",
+                   "Q2", "Q2", "Q2", "Q3", "Q3", "Q3"], dtype=object)
+_FY_OFFSET = np.array([0, 0, 0, 1, 1, 1, 1, 1, 1, 1, 1, 1])
+
+
+def add_fiscal_quarter(df: pd.DataFrame) -> None:
+    """
+    Add "FY" (e.g. FY25), "Q" (Q1-Q4) and "FYQ" (e.g. "FY25 Q1") columns to
+    *df* from its datetime "Month": Apr-Jun = Q1, Jul-Sep = Q2, Oct-Dec = Q3,
+    Jan-Mar = Q4, by whole-column table lookups on the month index.
+    Undated rows get no FY / quarter.
+    """
+    dated = df["Month"].notna()
+    m0 = df["Month"].dt.month.fillna(1).to_numpy(dtype=int) - 1
+    fy_year = (df["Month"].dt.year.fillna(0).to_numpy(dtype=int) + _FY_OFFSET[m0]) % 100
+    df["FY"]  = ("FY" + pd.Series(fy_year, index=df.index).astype(str).str.zfill(2)).where(dated)
+    df["Q"]   = pd.Series(_Q_LUT[m0], index=df.index).where(dated)
+    df["FYQ"] = df["FY"] + " " + df["Q"]
@@ -1,12 +1,18 @@
 # pipeline/invoice_data_pull.py
 from __future__ import annotations
+import hashlib
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from io import BytesIO
 from dateutil.relativedelta import relativedelta
 import pandas as pd
-from sqlalchemy import create_engine
+from sqlalchemy import text
 from textwrap import dedent
 
+from pipeline.data_pull import _get_engine, _read_query, _read_query_cache, _write_query_cache
+from pipeline.excel import write_xlsx
+
 # ──────────────────────────────────────────────────────────
 # CORE – call this from Streamlit or a notebook
 # ──────────────────────────────────────────────────────────
@@ -20,43 +26,173 @@ def _quote(dt: str) -> str:
     return f'{tbl}."{col}"'
 
 
+# date columns the pull can filter / bucket on, quoted once; date_type is
+# spliced into the SQL, so nothing outside this list is accepted
+_QUOTED_DT = {dt: _quote(dt) for dt in (
+    "i.createdAt", "i.updatedAt", "epri.activatedOn", "epri.toBeClearedOnUtc",
+)}
+
+# (granularity, date_type) -> (bucket expression, bucket column name)
+_BUCKETS = {
+    (granularity, dt): (f"DATE_TRUNC('{unit}', {quoted})", name)
+    for granularity, unit, name in (("daily", "day", "Day"), ("weekly", "week", "Week Start"))
+    for dt, quoted in _QUOTED_DT.items()
+}
+
+# a long range is pulled as up to this many sub-ranges side by side (one per
+# pooled connection), each at least _MIN_PART_DAYS long
+_MAX_PARTS = 4
+_MIN_PART_DAYS = 7
+
+
+def _split_range(from_date, to_date, granularity: str) -> list[tuple]:
+    """
+    Contiguous [start, end) dates covering from_date … to_date, each at
+    least _MIN_PART_DAYS long, cut on bucket boundaries (cuts are counted
+    from the first Monday on/after the start for weekly) so no bucket spans
+    two sub-ranges and their results concatenate in bucket order.
+    """
+    start = pd.Timestamp(from_date).normalize()
+    stop = pd.Timestamp(to_date).normalize() + pd.Timedelta(days=1)
+    if granularity == "weekly":
+        anchor, unit = start + pd.Timedelta(days=-start.weekday() % 7), 7
+    else:
+        anchor, unit = start, 1
+    # whole buckets from the anchor on; every part gets step of them (the
+    # first also takes the lead-in before the anchor, the last the rest)
+    units = max((stop - anchor).days // unit, 0)
+    n = min(_MAX_PARTS, units * unit // _MIN_PART_DAYS)
+    if n <= 1:
+        return [(start.date(), stop.date())]
+    step = units // n
+    cuts = [anchor + pd.Timedelta(days=step * unit * k) for k in range(1, n)]
+    bounds = [start, *cuts, stop]
+    return [(a.date(), b.date()) for a, b in zip(bounds, bounds[1:])]
+
+
+# Buyer Revenue Share rules, keyed on buyer org id
+# flat % of the effective discount
+_FLAT_SHARE = {
+    0.0875: {448, 9916, 158109},
+    0.095:  {586},
+    0.10:   {10963, 11326, 11, 246800, 275674},
+    0.15:   {24217, 136067, 4752, 154673},
+    0.14:   {22483, 199095},
+    0.13:   {368},
+    0.18:   {193694},
+    0.20:   {8933},
+}
+# share of the spread over a base APR: ids -> (base, share)
+_SPREAD_SHARE = {
+    (66,452,546,431): (7.0, 0.20),
+    (11323,):        (6.5, 0.16),
+    (8672,):         (8.0, 0.10),
+    (1437,):         (6.5, 0.20),
+    (153,):          (9.0, 0.35),
+    (55,):           (7.34,0.11),
+    (196860,196029): (8.0, 0.50),
+    (38,):           (10.0,0.15),
+}
+# Zydus tier: % of the APR over 8, stepped on invoice amount
+_ZYDUS_IDS = {24814, 11111, 128999}
+
+
+# buyer org id -> (rule, base APR, share): one entry per buyer, so each
+# invoice row classifies with a single lookup
+_BID_RULE: dict[int, tuple[str, float | None, float | None]] = {
+    **{bid: ("flat", None, pct) for pct, ids in _FLAT_SHARE.items() for bid in ids},
+    688: ("apr_step", None, None),
+    379: ("rate", None, 0.35),
+    **{bid: ("spread", base, share) for ids, (base, share) in _SPREAD_SHARE.items() for bid in ids},
+    **{bid: ("zydus", 8.0, None) for bid in _ZYDUS_IDS},
+}
+
+
+def _sql_num(v: float | None) -> str:
+    return "NULL::float8" if v is None else f"{v}::float8"
+
+
+# _BID_RULE as an inline table, joined to the invoice rows on buyer id
+_BUYER_RULE_SQL = (
+    "(VALUES\n"
+    + ",\n".join(
+        f"    ({bid}, '{rule}', {_sql_num(base)}, {_sql_num(share)})"
+        for bid, (rule, base, share) in sorted(_BID_RULE.items())
+    )
+    + "\n) AS r (buyer_id, rule, base, share)"
+)
+
+# Buyer Revenue Share per invoice row, by the buyer's rule in r.  A NULL
+# operand (e.g. no EPR yet, so no apr / effectiveDiscount) leaves the share
+# NULL rather than 0, so missing data stays distinguishable from no share;
+# buyers without a rule get 0
+_BUYER_SHARE_SQL = dedent("""\
+    (CASE r.rule
+        WHEN 'flat'     THEN epri."effectiveDiscount" * r.share
+        WHEN 'apr_step' THEN epri."effectiveDiscount"
+                             * CASE WHEN epri."apr" < 15 THEN 0.12 ELSE 0.15 END
+        -- share of ED-rate × amount
+        WHEN 'rate'     THEN (epri."effectiveDiscountRate" / 100.0 * i."amount") * r.share
+        WHEN 'spread'   THEN ((epri."apr" - r.base) * i."amount" * epri."daysAdvanced" / 36500.0) * r.share
+        WHEN 'zydus'    THEN CASE
+                               WHEN epri."apr" - r.base <= 0 THEN 0
+                               ELSE CASE
+                                      WHEN i."amount" < 15e7 THEN 0.125
+                                      WHEN i."amount" < 25e7 THEN 0.15
+                                      ELSE 0.175
+                                    END * (epri."apr" - r.base) * i."amount" / 100.0
+                             END
+        ELSE 0
+    END)::float8""")
+
+
+def to_xlsx_bytes(df: pd.DataFrame) -> bytes:
+    """Serialise *df* to an in-memory XLSX (for download buttons)."""
+    buf = BytesIO()
+    write_xlsx(df, buf)   # xlsxwriter, streamed row by row
+    return buf.getvalue()
+
+
 def run_invoice_pull(
     from_date,
     to_date,
     granularity: str = "daily",
     date_type: str = "i.createdAt",
-    out_dir: str = "Output",
+    out_dir: str | None = "Output",
+    out_format: str = "xlsx",
+    cache_ttl: float = 900,
 ) -> pd.DataFrame:
     """
     Pull invoice-level data (incl. Buyer Revenue Share logic) for **one month**.
 
-    Returns the DataFrame and writes an Excel file in <out_dir>.
+    Returns the DataFrame and writes an Excel file in <out_dir>, or a zstd
+    Parquet file with ``out_format="parquet"`` (pass ``out_dir=None`` to
+    skip the file and keep everything in memory).
+
+    With an *out_dir*, the raw query result is kept under ``<out_dir>/.cache``
+    keyed by a hash of the SQL and date range; pulls within *cache_ttl*
+    seconds of it reuse that instead of querying again (``cache_ttl=0``
+    always queries).
     """
-    # 1 ── DB creds (pick up from env or hard-code while testing)
-    PG_USER = os.getenv("PG_USER")
-    PG_PASSWORD = os.getenv("PG_PASSWORD")
-    PG_HOST = os.getenv("PG_HOST")
-    PG_DB = os.getenv("PG_DB")
-
-    engine = create_engine(
-        f"postgresql+psycopg2://{PG_USER}:{PG_PASSWORD}@{PG_HOST}/{PG_DB}",
-        connect_args={"options": "-c statement_timeout=0"},
-    )
+    if out_format not in ("xlsx", "parquet"):
+        raise ValueError(f"Unsupported out_format: {out_format!r} (use 'xlsx' or 'parquet')")
+    if granularity not in ("daily", "weekly"):
+        raise ValueError(f"Unsupported granularity: {granularity!r} (use 'daily' or 'weekly')")
+    if date_type not in _QUOTED_DT:
+        raise ValueError(f"Unsupported date_type: {date_type!r} (use one of {', '.join(_QUOTED_DT)})")
 
-    # 2 ── Month boundaries
-    # 2️⃣  choose bucket expression
-    quoted_dt = _quote(date_type)  # ensures proper quoting like i."createdAt"
+    # 1 ── DB engine (shared, pooled; creds come from env)
+    engine = _get_engine()
 
-    if granularity == "weekly":
-        bucket_sql = f'DATE_TRUNC(\'week\', {quoted_dt}) AS "Week Start"'
-    else:
-        bucket_sql = f'DATE_TRUNC(\'day\', {quoted_dt}) AS "Day"'
-    
-    
-    # 3 ── Invoice-level query (no aggregation)
-    query = dedent(f"""
+    # 2 ── choose bucket expression (prebuilt, see _BUCKETS)
+    quoted_dt = _QUOTED_DT[date_type]  # properly quoted, like i."createdAt"
+    bucket_expr, bucket_name = _BUCKETS[(granularity, date_type)]
+
+    # 3 ── Invoice-level query (no aggregation); Buyer Revenue Share is
+    #      evaluated by Postgres in the same scan
+    query = text(dedent(f"""
         SELECT
-            {bucket_sql},
+            {bucket_expr} AS "{bucket_name}",
             {quoted_dt}                         AS "Invoice Timestamp",
             vendororg."PAN"                     AS "PAN",
             vendororg."legalName"               AS "Supplier Name",
@@ -71,7 +207,8 @@ def run_invoice_pull(
             epri."effectiveDiscountRate",
             epri."daysAdvanced",
             epri."apr",
-            epr."platformFee"
+            epr."platformFee",
+            {_BUYER_SHARE_SQL}  AS "Buyer Revenue Share"
 
         FROM discounting."Invoice"                    i
         LEFT JOIN discounting."EarlyPaymentRequestInvoice" epri
@@ -82,83 +219,57 @@ def run_invoice_pull(
                ON p.id = COALESCE(i."partnerId", epr."partnerId")
         LEFT JOIN tenant."Organization"           vendororg  ON vendororg.id = p."vendorOrgId"
         LEFT JOIN tenant."Organization"           buyerorg   ON buyerorg.id = p."buyerOrgId"
-        WHERE {quoted_dt} BETWEEN '{from_date}' AND '{to_date}'
-        
-    """)
-
-    df = pd.read_sql_query(query, engine)
-
-    # 4 ── Buyer Revenue Share (same rules as your huge SQL CASE)
-    def buyer_share(r: pd.Series) -> float:
-        bid  = int(r["Buyer Org ID"]) if pd.notna(r["Buyer Org ID"]) else 0
-        ed   = r["effectiveDiscount"] or 0
-        amt  = r["Invoice Amount"]    or 0
-        apr  = r["apr"]               or 0
-        days = r["daysAdvanced"]      or 0
-        rate = r["effectiveDiscountRate"] or 0
-
-        # --- flat % table ---
-        flats = {
-            0.0875: {448, 9916, 158109},
-            0.095:  {586},
-            0.10:   {10963, 11326, 11, 246800, 275674},
-            0.15:   {24217, 136067, 4752, 154673},
-            0.14:   {22483, 199095},
-            0.13:   {368},
-            0.18:   {193694},
-            0.20:   {8933},
-        }
-        for pct, ids in flats.items():
-            if bid in ids:
-                return ed * pct
-        if bid == 688:
-            return ed * (0.12 if apr < 15 else 0.15)
-
-        # % of ED-rate × amount
-        if bid == 379:
-            return (rate / 100 * amt) * 0.35
-
-        # spread-based
-        spreads = {
-            (66,452,546,431): (7.0, 0.20),
-            (11323,):        (6.5, 0.16),
-            (8672,):         (8.0, 0.10),
-            (1437,):         (6.5, 0.20),
-            (153,):          (9.0, 0.35),
-            (55,):           (7.34,0.11),
-            (196860,196029): (8.0, 0.50),
-            (38,):           (10.0,0.15),
-        }
-        for ids,(base,share) in spreads.items():
-            if bid in ids:
-                return ((apr-base)*amt*days/36500)*share
-
-        # Zydus tier
-        if bid in {24814, 11111, 128999}:
-            net_apr = apr - 8
-            if net_apr <= 0: return 0
-            if   amt < 15e7: pct = 0.125
-            elif amt < 25e7: pct = 0.15
-            else:            pct = 0.175
-            return pct * net_apr * amt / 100
-
-        return 0.0
-
-    df["Buyer Revenue Share"] = df.apply(buyer_share, axis=1)
-
-    # 5 ── tidy up and save
-    bucket_name = "Day" if granularity == "daily" else "Week Start"
-    df.sort_values([bucket_name, "PAN", "invoiceNumber"], inplace=True)
-
-    # 🔧 Fix timezone issue
-    for col in df.select_dtypes(include=["datetimetz"]).columns:
-        df[col] = df[col].dt.tz_convert(None)   # <-- MUST BE BEFORE to_excel
-
-    os.makedirs(out_dir, exist_ok=True)
-    out_path = os.path.join(
-        out_dir, f"invoice_metrics_{from_date}_{to_date}_{granularity}.xlsx"
-    )
-    df.to_excel(out_path, index=False)   # <- now this will not crash
+        LEFT JOIN {_BUYER_RULE_SQL}                          ON r.buyer_id = buyerorg.id
+        -- the outer BETWEEN is the caller's exact range; the sub-range
+        -- bounds only narrow it.  Every part runs this same text, and the
+        -- planner folds both pairs into one index range (tightest bound
+        -- wins), so the extra pair costs nothing
+        WHERE {quoted_dt} BETWEEN :from_date AND :to_date
+          AND {quoted_dt} >= :part_start AND {quoted_dt} < :part_end
+        ORDER BY {bucket_expr}, vendororg."PAN", i."invoiceNumber"
+    """))
+
+    params = {"from_date": from_date, "to_date": to_date}
+
+    # reuse the cached result of the same query and range, if fresh enough
+    cache_path = None
+    df = None
+    if out_dir is not None:
+        key = hashlib.blake2b(f"{query.text}{sorted(params.items())}".encode(), digest_size=8).hexdigest()
+        cache_path = os.path.join(out_dir, ".cache", f"invoice_{key}.parquet")
+        df = _read_query_cache(cache_path, cache_ttl)
+    if df is None:
+        # each sub-range streamed through its own server-side cursor, in
+        # parallel on the pooled connections; Arrow-backed dtypes
+        parts = _split_range(from_date, to_date, granularity)
+        with ThreadPoolExecutor(max_workers=len(parts)) as pool:
+            frames = list(pool.map(
+                lambda part: _read_query(
+                    query, engine, {**params, "part_start": part[0], "part_end": part[1]}
+                ),
+                parts,
+            ))
+        df = pd.concat(frames, ignore_index=True)
+        # org ids fit a nullable int32
+        df = df.astype({"Buyer Org ID": "int32[pyarrow]"})
+        if cache_path is not None:
+            _write_query_cache(cache_path, df)
+
+    # 4 ── tidy up and save (rows already arrive sorted by bucket, PAN, invoice)
+    # 🔧 Fix timezone issue: every tz-aware column (numpy or Arrow
+    # timestamp) to naive UTC in one pass  <-- MUST BE BEFORE to_excel
+    tz_cols = [c for c, t in df.dtypes.items() if getattr(getattr(t, "pyarrow_dtype", t), "tz", None)]
+    df = df.assign(**{c: df[c].dt.tz_convert(None) for c in tz_cols})
+
+    if out_dir is not None:
+        os.makedirs(out_dir, exist_ok=True)
+        out_path = os.path.join(
+            out_dir, f"invoice_metrics_{from_date}_{to_date}_{granularity}.{out_format}"
+        )
+        if out_format == "parquet":
+            df.to_parquet(out_path, engine="pyarrow", compression="zstd", index=False)
+        else:
+            write_xlsx(df, out_path)   # <- now this will not crash
     return df  # caller can still use the DataFrame
 
 
@@ -171,14 +282,21 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Invoice-level data pull")
     parser.add_argument("month", help="Month in YYYY-MM format (e.g. 2024-03)")
     parser.add_argument("--granularity", choices=["daily", "weekly"], default="daily")
-    parser.add_argument("--date-type", default="i.createdAt")
+    parser.add_argument("--date-type", choices=list(_QUOTED_DT), default="i.createdAt")
     parser.add_argument("--out-dir", default="Output")
+    parser.add_argument("--out-format", choices=["xlsx", "parquet"], default="xlsx")
     args = parser.parse_args()
 
+    # the whole calendar month, as from / to dates like the dashboard passes
+    from_date = datetime.strptime(args.month, "%Y-%m").date()
+    to_date = from_date + relativedelta(months=1, days=-1)
+
     df_out = run_invoice_pull(
-        month=args.month,
+        from_date=from_date,
+        to_date=to_date,
         granularity=args.granularity,
         date_type=args.date_type,
         out_dir=args.out_dir,
+        out_format=args.out_format,
     )
     print(f"✅  Pulled {len(df_out):,} rows → {pathlib.Path(args.out_dir).resolve()}")